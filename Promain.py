@@ -2,24 +2,42 @@
 import os
 import io
 import csv
+import gzip
+import tempfile
 import time
 import math
 import random
 import string
+import heapq
+from array import array
 import logging
+import threading
+import collections
 import traceback
+import functools
+import atexit
+import asyncio
+import json
+import hmac
+import socket
+import queue
+import http.server
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, timedelta, timezone
 
 from dotenv import load_dotenv
 import telebot
-from telebot import types
+from telebot import types, apihelper
 from telebot.types import Message, CallbackQuery
 from telebot.apihelper import ApiException
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index
+    create_engine, make_url, Column, Integer, String, DateTime, Date, Boolean, Float, ForeignKey, Text, Index,
+    inspect, text, insert, update, select, event, func, case, cast
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session, Session, selectinload
+from sqlalchemy.exc import IntegrityError
 
 # ============================
 # Load env
@@ -32,6 +50,8 @@ ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split("
 CARD_NUMBER = os.getenv("CARD_NUMBER", "").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot.db")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()  # polling | webhook
+RUNTIME = os.getenv("RUNTIME", "sync").lower()        # sync | async (AsyncTeleBot + async engine)
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set in .env")
@@ -51,13 +71,349 @@ logging.basicConfig(
 )
 log = logging.getLogger("ShopBot")
 
+# ============================
+# Metrics
+# ============================
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # separate /metrics listener (0 = off; webhook mode serves it anyway)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """
+    In-process counters and latency histograms, rendered as Prometheus text.
+    Latencies are grouped by family ("handler", "callback", "fn", "telegram") and name.
+    Handlers run inside an update scope: SQL statements and commits issued on that thread
+    until the handler returns are attributed to the update (db-writer batches are counted
+    separately, since one commit there serves many updates).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}                       # (family, name) -> [count, sum_s, max_s, *bucket_counts]
+        self.counters = collections.Counter()   # (metric, labels) -> value
+        self.gauges = {}                        # (metric, labels) -> value
+        self.collectors = []                    # fn() -> [(metric, labels, value)] read at render time
+        self.local = threading.local()
+        self.db_updates = [0, 0, 0, 0]          # updates, statements, commits, max statements
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def observe(self, family: str, name: str, seconds: float):
+        with self.lock:
+            t = self.timings.get((family, name))
+            if t is None:
+                t = self.timings[(family, name)] = [0, 0.0, 0.0] + [0] * len(METRICS_BUCKETS)
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    t[3 + i] += 1
+                    break
+
+    def inc(self, metric: str, n: float = 1, **labels):
+        with self.lock:
+            self.counters[(metric, self._labels(labels))] += n
+
+    def set(self, metric: str, value: float, **labels):
+        with self.lock:
+            self.gauges[(metric, self._labels(labels))] = value
+
+    def timed(self, family: str, name: str = None):
+        """Decorator: time every call of fn as (family, name or fn.__name__)."""
+        def deco(fn):
+            key = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(family, key, time.perf_counter() - started)
+            return wrapper
+        return deco
+
+    def update_handler(self, fn, family: str = "handler"):
+        """Wrap a bot handler: time it and attribute the thread's DB work to this update."""
+        key = fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self.local, "db", None)
+            if outer is None:
+                self.local.db = [0, 0]
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.observe(family, key, time.perf_counter() - started)
+                if outer is None:
+                    statements, commits = self.local.db
+                    self.local.db = None
+                    with self.lock:
+                        u = self.db_updates
+                        u[0] += 1
+                        u[1] += statements
+                        u[2] += commits
+                        u[3] = max(u[3], statements)
+        return wrapper
+
+    def watch_engine(self, eng):
+        writer_name = "db-writer"
+
+        @event.listens_for(eng, "before_cursor_execute")
+        def _on_statement(*_):
+            scope = getattr(self.local, "db", None)
+            if scope is not None:
+                scope[0] += 1
+            self.inc("db_statements_total", source="writer" if threading.current_thread().name == writer_name else "handler")
+
+        @event.listens_for(eng, "commit")
+        def _on_commit(*_):
+            scope = getattr(self.local, "db", None)
+            if scope is not None:
+                scope[1] += 1
+            self.inc("db_commits_total", source="writer" if threading.current_thread().name == writer_name else "handler")
+
+    def watch_telegram(self):
+        """Time every Bot API request by method (wraps telebot's single HTTP entry point)."""
+        original = apihelper._make_request
+
+        def timed_request(token, method_name, method="get", params=None, files=None):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return original(token, method_name, method=method, params=params, files=files)
+            except apihelper.ApiTelegramException as e:
+                status = str(e.error_code)
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                self.observe("telegram", method_name, time.perf_counter() - started)
+                self.inc("telegram_requests_total", method=method_name, status=status)
+
+        apihelper._make_request = timed_request
+
+    def watch_telegram_async(self):
+        """Same as watch_telegram for AsyncTeleBot (asyncio_helper._process_request)."""
+        from telebot import asyncio_helper
+        original = asyncio_helper._process_request
+
+        async def timed_request(token, url, method="get", params=None, files=None, **kwargs):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return await original(token, url, method=method, params=params, files=files, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                status = str(e.error_code)
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                self.observe("telegram", url, time.perf_counter() - started)
+                self.inc("telegram_requests_total", method=url, status=status)
+
+        asyncio_helper._process_request = timed_request
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        with self.lock:
+            timings = {k: list(v) for k, v in self.timings.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            db_updates = list(self.db_updates)
+        lines = []
+        for family in sorted({f for f, _ in timings}):
+            metric = f"shopbot_{family}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (fam, name), t in sorted(timings.items()):
+                if fam != family:
+                    continue
+                cumulative = 0
+                for bound, n in zip(METRICS_BUCKETS, t[3:]):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{name="{name}",le="+Inf"}} {t[0]}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {t[1]:.6f}')
+                lines.append(f'{metric}_count{{name="{name}"}} {t[0]}')
+        for metric in sorted({m for m, _ in counters}):
+            lines.append(f"# TYPE shopbot_{metric} counter")
+            lines.extend(f"shopbot_{m}{fmt(l)} {v:g}" for (m, l), v in sorted(counters.items()) if m == metric)
+        updates, statements, commits, max_statements = db_updates
+        for metric, total in (("db_update_statements", statements), ("db_update_commits", commits)):
+            lines.append(f"# TYPE shopbot_{metric} summary")
+            lines.append(f"shopbot_{metric}_sum {total}")
+            lines.append(f"shopbot_{metric}_count {updates}")
+        gauges[("db_update_statements_max", ())] = max_statements
+        for collect in self.collectors:
+            try:
+                for metric, labels, value in collect():
+                    gauges[(metric, self._labels(labels))] = value
+            except Exception:
+                log.debug("Metrics collector failed: %s", traceback.format_exc())
+        for metric in sorted({m for m, _ in gauges}):
+            lines.append(f"# TYPE shopbot_{metric} gauge")
+            lines.extend(f"shopbot_{m}{fmt(l)} {v:g}" for (m, l), v in sorted(gauges.items()) if m == metric)
+        return "\n".join(lines) + "\n"
+
+    def report(self, top: int = 12) -> str:
+        """Short human summary for /perf: slowest names by total time, DB work per update."""
+        with self.lock:
+            rows = sorted(self.timings.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+            updates, statements, commits, max_statements = self.db_updates
+        out = [f"{'name':<28}{'n':>7}{'avg ms':>9}{'max ms':>9}"]
+        for (family, name), t in rows:
+            out.append(f"{(family[0] + ':' + name)[:27]:<28}{t[0]:>7}{t[1] / t[0] * 1000:>9.1f}{t[2] * 1000:>9.0f}")
+        if updates:
+            out.append(f"\nDB/update: {statements / updates:.2f} stmt, {commits / updates:.2f} commit, max {max_statements} stmt")
+        return "\n".join(out)
+
+metrics = Metrics()
+metrics.watch_telegram()
+
+def start_metrics_server(listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+    """Serve GET /metrics on its own port (used in polling mode)."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            body = metrics.render().encode() if self.path == "/metrics" else b""
+            self.send_response(200 if body else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = http.server.ThreadingHTTPServer((listen, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    log.info("Metrics on http://%s:%s/metrics", listen, port)
+    return httpd
+
 # ============================
 # Database (SQLAlchemy)
 # ============================
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True, future=True)
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+# sqlite:// and sqlite:///:memory: get a SingletonThreadPool, which takes no pool sizing
+SQLITE_IN_MEMORY = IS_SQLITE and make_url(DATABASE_URL).database in (None, "", ":memory:")
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production").lower()  # production | off
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "64"))
+# handler threads (polling/webhook workers + background workers) each hold at most one connection
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(max(4, (os.cpu_count() or 1) * 2) + 8)))
+
+def sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")      # readers never block the writer
+    cur.execute("PRAGMA synchronous=NORMAL")    # fsync at checkpoints, not every commit
+    cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+def make_engine():
+    kwargs = {"echo": False, "pool_pre_ping": True, "future": True}
+    if not SQLITE_IN_MEMORY:
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+    if IS_SQLITE:
+        kwargs["connect_args"] = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    eng = create_engine(DATABASE_URL, **kwargs)
+    if IS_SQLITE and SQLITE_PROFILE == "production":
+        event.listen(eng, "connect", sqlite_pragmas)
+    return eng
+
+engine = make_engine()
+metrics.watch_engine(engine)
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
 
+DB_WRITER = os.getenv("DB_WRITER", "1" if IS_SQLITE else "0") == "1"
+DB_WRITER_BATCH = int(os.getenv("DB_WRITER_BATCH", "200"))
+DB_WRITER_WAIT_MS = float(os.getenv("DB_WRITER_WAIT_MS", "2"))
+
+class DbWriter:
+    """
+    Single writer thread for hot write paths. Jobs are fn(session) callables; whatever is
+    queued (up to DB_WRITER_BATCH, waiting DB_WRITER_WAIT_MS for more) runs in ONE
+    transaction, so concurrent handlers share a commit instead of fighting for SQLite's
+    write lock. If the batch fails, each job is retried alone so one bad job can't sink
+    the others. Jobs must not call run()/submit() themselves.
+    With DB_WRITER=0 run() simply executes the job in its own transaction.
+    """
+
+    def __init__(self, enabled: bool = DB_WRITER, batch: int = DB_WRITER_BATCH, wait_ms: float = DB_WRITER_WAIT_MS):
+        self.enabled = enabled
+        self.batch = batch
+        self.wait = wait_ms / 1000.0
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.jobs_done = 0
+
+    def submit(self, fn) -> Future:
+        fut = Future()
+        if not self.enabled:
+            self._run_batch([(fn, fut)])
+            return fut
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                    self.thread.start()
+        self.jobs.put((fn, fut))
+        return fut
+
+    def run(self, fn, timeout: float = 30):
+        return self.submit(fn).result(timeout)
+
+    def _loop(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.jobs.get(timeout=remaining) if remaining > 0 else self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        s = SessionLocal()
+        try:
+            results = [fn(s) for fn, _ in batch]
+            s.commit()
+            self.commits += 1
+            self.jobs_done += len(batch)
+            for (_, fut), res in zip(batch, results):
+                fut.set_result(res)
+            return
+        except Exception as e:
+            s.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+        finally:
+            s.close()
+        for job in batch:
+            self._run_batch([job])
+
+db_writer = DbWriter()
+
 def now_utc():
     return datetime.now(timezone.utc)
 
@@ -65,6 +421,20 @@ def format_price_toman(value: int) -> str:
     s = f"{value:,}".replace(",", "٬")
     return f"{s} تومان"
 
+def as_utc(dt):
+    """SQLite hands back naive datetimes even for timezone=True columns."""
+    return dt.replace(tzinfo=timezone.utc) if dt is not None and dt.tzinfo is None else dt
+
+def upsert_insert():
+    """Dialect insert() that supports on_conflict_do_update, or None if the backend lacks it."""
+    if engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        return dialect_insert
+    return None
+
 def rand_code(n=6):
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=n))
 
@@ -87,6 +457,112 @@ class Setting(Base):
             session.add(row)
         else:
             row.value = value
+        if key != SETTINGS_VERSION_KEY:
+            # other processes notice the bump; this one invalidates on commit
+            Setting.increment(session, SETTINGS_VERSION_KEY)
+            session.info["settings_dirty"] = True
+
+    @staticmethod
+    def increment(session, key):
+        """value = value + 1 in one statement, so concurrent writers never produce the same number."""
+        bumped = session.execute(update(Setting).where(Setting.key == key)
+                                 .values(value=cast(cast(Setting.value, Integer) + 1, String))
+                                 .execution_options(synchronize_session=False)).rowcount
+        if not bumped:
+            session.add(Setting(key=key, value="1"))
+        if key != SETTINGS_VERSION_KEY:
+            Setting.increment(session, SETTINGS_VERSION_KEY)
+            session.info["settings_dirty"] = True
+
+SETTINGS_VERSION_KEY = "settings_version"
+SETTINGS_RECHECK_SEC = float(os.getenv("SETTINGS_RECHECK_SEC", "0"))  # >0 when several processes share the db
+
+class SettingsCache:
+    """
+    In-memory copy of the settings table. Loaded in one query, invalidated when a
+    session that called Setting.set commits. With SETTINGS_RECHECK_SEC > 0 it also
+    polls the settings_version row so writes from other processes are picked up.
+    """
+
+    def __init__(self, recheck_sec: float = SETTINGS_RECHECK_SEC):
+        self.recheck_sec = recheck_sec
+        self.values = None
+        self.checked = 0.0
+        self.lock = threading.Lock()  # held by loads and invalidations alike
+
+    def invalidate(self):
+        # waits for a load in progress (it may have read the old rows), then drops its result
+        with self.lock:
+            self.values = None
+
+    def _load(self):
+        """Caller holds self.lock."""
+        s = SessionLocal()
+        try:
+            values = {k: v for k, v in s.query(Setting.key, Setting.value)}
+        finally:
+            s.close()
+        self.values = values
+        self.checked = time.monotonic()
+        return values
+
+    def _version_changed(self) -> bool:
+        s = SessionLocal()
+        try:
+            version = Setting.get(s, SETTINGS_VERSION_KEY, "0")
+        finally:
+            s.close()
+        self.checked = time.monotonic()
+        return version != self.values.get(SETTINGS_VERSION_KEY, "0")
+
+    def is_fresh(self) -> bool:
+        """True when snapshot() can answer from memory without touching the db."""
+        return self.values is not None and (not self.recheck_sec or time.monotonic() - self.checked < self.recheck_sec)
+
+    def snapshot(self) -> dict:
+        values = self.values
+        if values is not None and (not self.recheck_sec or time.monotonic() - self.checked < self.recheck_sec):
+            return values
+        with self.lock:
+            if self.values is None or (self.recheck_sec and time.monotonic() - self.checked >= self.recheck_sec
+                                       and self._version_changed()):
+                return self._load()
+            return self.values
+
+    def get(self, key: str, default: str = None) -> str:
+        return self.snapshot().get(key, default)
+
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        return self.get(key, "1" if default else "0") == "1"
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        try:
+            return int(self.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+settings_cache = SettingsCache()
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_settings_on_commit(session):
+    if session.info.pop("settings_dirty", False):
+        settings_cache.invalidate()
+
+def on_commit(session, fn):
+    """Run fn() once the session's current transaction commits; dropped if it rolls back."""
+    session.info.setdefault("on_commit", []).append(fn)
+
+@event.listens_for(Session, "after_commit")
+def _run_on_commit(session):
+    for fn in session.info.pop("on_commit", []):
+        try:
+            fn()
+        except Exception:
+            log.error("on_commit hook error: %s", traceback.format_exc())
+
+@event.listens_for(Session, "after_rollback")
+def _drop_on_commit(session):
+    session.info.pop("on_commit", None)
 
 class User(Base):
     __tablename__ = "users"
@@ -100,7 +576,8 @@ class User(Base):
     allow_broadcast = Column(Boolean, default=True)
     blocked = Column(Boolean, default=False)
 
-    orders = relationship("Order", back_populates="user", lazy="selectin")
+    # never loaded implicitly; admin views opt in with options(selectinload(User.orders))
+    orders = relationship("Order", back_populates="user", lazy="raise_on_sql")
 
 Index("idx_users_last_seen", User.last_seen_at)
 
@@ -157,12 +634,37 @@ class Order(Base):
     created_at = Column(DateTime(timezone=True), default=now_utc)
     updated_at = Column(DateTime(timezone=True), default=now_utc, onupdate=now_utc)
 
-    user = relationship("User", back_populates="orders")
-    vpn_product = relationship("VpnProduct")
-    app_plan = relationship("AppPlan")
+    user = relationship("User", back_populates="orders", lazy="raise_on_sql")
+    vpn_product = relationship("VpnProduct", lazy="raise_on_sql")
+    app_plan = relationship("AppPlan", lazy="raise_on_sql")
 
-Index("idx_orders_user_status", Order.user_id, Order.status)
+# Covers the "latest open order of a user" lookup in attach_proof (no sort step).
+Index("idx_orders_user_status_created", Order.user_id, Order.status, Order.created_at)
 Index("idx_orders_created", Order.created_at)
+Index("idx_orders_status_id", Order.status, Order.id)  # admin browser: newest orders of one status
+
+class OrderStatsDaily(Base):
+    """Per-day order rollup (by order creation date, UTC), maintained on every status change."""
+    __tablename__ = "order_stats_daily"
+    day = Column(Date, primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    approved = Column(Integer, nullable=False, default=0)   # approved or delivered
+    delivered = Column(Integer, nullable=False, default=0)
+    income = Column(Integer, nullable=False, default=0)     # toman, approved or delivered
+
+class OrderNode(Base):
+    """Order-code node ids leased by bot processes that run without ORDER_NODE_ID."""
+    __tablename__ = "order_nodes"
+    node_id = Column(Integer, primary_key=True, autoincrement=False)  # 0..35
+    owner = Column(String(64), nullable=False)                        # WORKER_ID
+    lease_until = Column(DateTime(timezone=True), nullable=False)
+
+class ConversationState(Base):
+    """Backing table for SqlStateStore (admin flows shared across processes)."""
+    __tablename__ = "conversation_state"
+    key = Column(String(64), primary_key=True)
+    value = Column(Text, nullable=False)      # JSON
+    expires_at = Column(Float, nullable=False)  # unix time
 
 class BroadcastLog(Base):
     __tablename__ = "broadcasts"
@@ -170,13 +672,73 @@ class BroadcastLog(Base):
     admin_id = Column(Integer, nullable=False)
     from_chat_id = Column(Integer, nullable=False)
     message_id = Column(Integer, nullable=False)
-    segment = Column(String(32), nullable=False)    # "all" | "active30"
+    segment = Column(String(32), nullable=False)    # AUDIENCE_SEGMENTS key
     sent_ok = Column(Integer, default=0)
     sent_fail = Column(Integer, default=0)
     created_at = Column(DateTime(timezone=True), default=now_utc)
 
+    # Durable job state: queued -> running -> done (rows from before jobs existed read as "done")
+    status = Column(String(16), nullable=False, default="queued", server_default="done")
+    total = Column(Integer, default=0)
+    sent_blocked = Column(Integer, default=0)
+    report_chat_id = Column(Integer, nullable=True)     # where to post the final report
+    report_message_id = Column(Integer, nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    # Worker lease: only the process named in owner sends for this job while lease_until is in the future
+    owner = Column(String(64), nullable=True)
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+
+Index("idx_broadcasts_status", BroadcastLog.status)
+
+class BroadcastRecipient(Base):
+    __tablename__ = "broadcast_recipients"
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, ForeignKey("broadcasts.id"), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    state = Column(String(16), nullable=False, default="pending")
+    # pending -> sending -> sent | failed | blocked
+    # "sending" is claimed but not confirmed; when the job's lease expires (its process died)
+    # those rows are settled as failed, never re-sent.
+    updated_at = Column(DateTime(timezone=True), default=now_utc, onupdate=now_utc)
+
+Index("idx_bcast_recipients_job_state", BroadcastRecipient.broadcast_id, BroadcastRecipient.state, BroadcastRecipient.id)
+
+# indexes older versions created that the models no longer declare (table -> names)
+RETIRED_INDEXES = {
+    "orders": ["idx_orders_user_status"],  # covered by idx_orders_user_status_created
+}
+
+def upgrade_schema():
+    """
+    create_all() never alters existing tables; add any model columns missing from the db
+    and drop indexes listed in RETIRED_INDEXES (each one costs a write on every insert).
+    """
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            present = {i["name"] for i in insp.get_indexes(table.name)}
+            for name in RETIRED_INDEXES.get(table.name, []):
+                if name in present:
+                    on = f" ON {table.name}" if engine.dialect.name == "mysql" else ""
+                    conn.execute(text(f"DROP INDEX {name}{on}"))
+                    log.info("Schema: dropped index %s", name)
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(engine.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT '{col.server_default.arg}'"
+                conn.execute(text(ddl))
+                log.info("Schema: added column %s.%s", table.name, col.name)
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+
 def init_db_and_seed():
     Base.metadata.create_all(engine)
+    upgrade_schema()
     s = SessionLocal()
     try:
         # Seed VPN products if empty
@@ -238,24 +800,272 @@ def init_db_and_seed():
 init_db_and_seed()
 
 # ============================
-# Bot
+# Bot API transport
 # ============================
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", skip_pending=True)
+# Every sync Bot API call (and file download) goes through one pooled keep-alive session.
+# Handler, notifier and broadcast threads share it; TG_POOL_SIZE caps open connections.
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", str(max(4, (os.cpu_count() or 1) * 2) + 20)))
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "15"))
+TG_RETRIES = int(os.getenv("TG_RETRIES", "2"))                       # extra attempts, idempotent methods only
+TG_RETRY_BASE_MS = float(os.getenv("TG_RETRY_BASE_MS", "200"))
+TG_RETRY_CAP_MS = float(os.getenv("TG_RETRY_CAP_MS", "2000"))
+TG_HTTP2 = os.getenv("TG_HTTP2", "0") == "1"                          # needs httpx[http2]
+
+# read timeouts by method; TG_TIMEOUTS="sendPhoto=60,answerCallbackQuery=3" overrides
+TG_METHOD_TIMEOUTS = {
+    "answerCallbackQuery": 5, "editMessageText": 10, "editMessageReplyMarkup": 10,
+    "sendMessage": 10, "copyMessage": 10, "deleteMessage": 10,
+    "sendPhoto": 30, "sendDocument": 60, "getFile": 15,
+}
+TG_METHOD_TIMEOUTS.update({k: float(v) for k, v in (
+    x.split("=", 1) for x in os.getenv("TG_TIMEOUTS", "").replace(" ", "").split(",") if "=" in x)})
+
+# Safe to send twice: reads, answers, edits (a repeat at worst gets "message is not modified").
+# sendMessage / copyMessage / send* would deliver duplicates, so they are retried only when
+# the connection was never established.
+TG_IDEMPOTENT = frozenset({
+    "getMe", "getFile", "getChat", "getChatMember", "getUpdates", "getWebhookInfo",
+    "answerCallbackQuery", "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+    "deleteMessage", "setWebhook", "deleteWebhook", "setMyCommands",
+})
+TG_RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+class BotApiTransport:
+    """
+    apihelper.CUSTOM_REQUEST_SENDER for the sync bot. One requests.Session with an
+    HTTPAdapter sized to TG_POOL_SIZE (blocking when all connections are busy instead of
+    opening throwaway ones), per-method read timeouts, and retries with full jitter for
+    idempotent methods. With TG_HTTP2=1 and httpx[http2] installed requests go over a
+    single multiplexed HTTP/2 connection instead. stats() reports connection reuse.
+    """
+
+    def __init__(self, pool_size: int = TG_POOL_SIZE, http2: bool = TG_HTTP2):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.requests = requests
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.client = None
+        if http2:
+            try:
+                import httpx
+                self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                            max_keepalive_connections=pool_size))
+                self.httpx = httpx
+                self.streams = set()  # ids of HTTP/2 connections seen, to count new ones
+            except ImportError:
+                log.warning("TG_HTTP2=1 but httpx[http2] is not installed; using HTTP/1.1 keep-alive")
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.retries = 0
+        self.h2_connections = 0
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+        apihelper.session = self.session  # file downloads use it too
+        return self
+
+    def install_async(self):
+        """Per-method timeouts for AsyncTeleBot (its aiohttp session already keeps connections alive)."""
+        from telebot import asyncio_helper
+        original = asyncio_helper._process_request
+
+        async def request(token, url, method="get", params=None, files=None, **kwargs):
+            if "request_timeout" not in kwargs and not (params and "timeout" in params):
+                kwargs["request_timeout"] = self.timeout(url)[1] + TG_CONNECT_TIMEOUT
+            return await original(token, url, method=method, params=params, files=files, **kwargs)
+
+        asyncio_helper._process_request = request
 
-# --- In-memory admin temp states ---
-ADMIN_STATE = {}  # {admin_id: {"mode": "...", "payload": {...}}}
+    @staticmethod
+    def timeout(method_name: str, given=None):
+        """(connect, read). getUpdates keeps the caller's long-polling timeout."""
+        if method_name == "getUpdates" and given:
+            return given
+        return TG_CONNECT_TIMEOUT, TG_METHOD_TIMEOUTS.get(method_name, TG_READ_TIMEOUT)
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        return random.uniform(0, min(TG_RETRY_CAP_MS, TG_RETRY_BASE_MS * 2 ** attempt)) / 1000.0
+
+    def _send(self, method, url, params, files, timeout, proxies):
+        if self.client is not None and not proxies:
+            r = self.client.request(method.upper(), url, params=params, files=files,
+                                    timeout=self.httpx.Timeout(timeout[1], connect=timeout[0]))
+            stream = r.extensions.get("network_stream")
+            if stream is not None and id(stream) not in self.streams:
+                with self.lock:
+                    self.streams.add(id(stream))
+                    self.h2_connections += 1
+            return r
+        return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        method_name = url.rsplit("/", 1)[-1]
+        timeout = self.timeout(method_name, timeout)
+        idempotent = method_name in TG_IDEMPOTENT and not files
+        attempt = 0
+        while True:
+            with self.lock:
+                self.sent += 1
+            try:
+                r = self._send(method, url, params, files, timeout, proxies)
+            except Exception as e:
+                never_sent = isinstance(e, self.requests.exceptions.ConnectTimeout) or (
+                    self.client is not None and isinstance(e, self.httpx.ConnectError))
+                if attempt >= TG_RETRIES or not (idempotent or never_sent) or not self._transient(e):
+                    raise
+            else:
+                if not (idempotent and r.status_code in TG_RETRY_STATUSES and attempt < TG_RETRIES):
+                    return r
+            attempt += 1
+            with self.lock:
+                self.retries += 1
+            metrics.inc("telegram_http_retries_total", method=method_name)
+            time.sleep(self.backoff(attempt))
+
+    def _transient(self, e: Exception) -> bool:
+        if isinstance(e, (self.requests.exceptions.ConnectionError, self.requests.exceptions.Timeout)):
+            return True
+        return self.client is not None and isinstance(e, self.httpx.TransportError)
+
+    def stats(self) -> dict:
+        """Requests sent, connections opened and the share of requests that reused one."""
+        if self.client is not None:
+            connections, requests_ = self.h2_connections, self.sent
+        else:
+            connections = requests_ = 0
+            pools = self.adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_ += pool.num_requests
+        reuse = 1 - connections / requests_ if requests_ else 0.0
+        return {"requests": requests_, "connections": connections, "reuse": max(0.0, reuse), "retries": self.retries}
+
+transport = BotApiTransport().install()
+metrics.collectors.append(lambda: [
+    ("telegram_http_" + k, {}, v) for k, v in transport.stats().items() if k != "retries"
+])
+
+# ============================
+# Bot
+# ============================
+# In webhook mode WebhookServer owns the worker pool and in the async runtime sync handlers run
+# in asyncio.to_thread, so in both cases telebot dispatches inline.
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", skip_pending=True,
+                      threaded=(RUN_MODE != "webhook" and RUNTIME != "async"),
+                      use_class_middlewares=True)  # UpdateGuardMiddleware
+
+# --- Admin conversation states ---
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()  # memory | db | file
+STATE_FILE = os.getenv("STATE_FILE", "state.db")               # used by STATE_BACKEND=file
+STATE_TTL = int(os.getenv("STATE_TTL", str(24 * 3600)))        # seconds
+
+class MemoryStateStore:
+    """Per-process state with TTLs; fine for a single bot process."""
+
+    def __init__(self, ttl: int = STATE_TTL):
+        self.ttl = ttl
+        self.data = {}  # {key: (expires_at, value)}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.time():
+                del self.data[key]
+                return default
+            return item[1]
+
+    def set(self, key, value, ttl: int = None):
+        with self.lock:
+            self.data[key] = (time.time() + (ttl or self.ttl), value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+        if item is None or item[0] < time.time():
+            return default
+        return item[1]
+
+class SqlStateStore:
+    """
+    State in a SQL table shared by every bot process using the same database (or the
+    same STATE_FILE). Operations are atomic per key: set is an UPSERT (a guarded
+    UPDATE-then-INSERT where the dialect has none) and pop is DELETE ... RETURNING
+    (SELECT ... FOR UPDATE + DELETE in one transaction elsewhere).
+    """
+
+    def __init__(self, engine_, ttl: int = STATE_TTL):
+        self.engine = engine_
+        self.ttl = ttl
+        ConversationState.__table__.create(engine_, checkfirst=True)
+
+    def get(self, key, default=None):
+        t = ConversationState.__table__
+        with self.engine.connect() as conn:
+            row = conn.execute(select(t.c.value).where(t.c.key == str(key), t.c.expires_at >= time.time())).first()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl: int = None):
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        t = ConversationState.__table__
+        row = {"key": str(key), "value": json.dumps(value), "expires_at": time.time() + (ttl or self.ttl)}
+        dialect_insert = upsert_insert() if self.engine is engine else sqlite_insert
+        with self.engine.begin() as conn:
+            if dialect_insert is not None:
+                stmt = dialect_insert(t).values(**row)
+                conn.execute(stmt.on_conflict_do_update(
+                    index_elements=[t.c.key], set_={"value": stmt.excluded.value, "expires_at": stmt.excluded.expires_at}))
+            else:
+                refresh = t.update().where(t.c.key == row["key"]).values(value=row["value"], expires_at=row["expires_at"])
+                if conn.execute(refresh).rowcount == 0:
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(t.insert().values(**row))
+                    except IntegrityError:
+                        conn.execute(refresh)  # another process inserted the key first
+            if random.random() < 0.01:
+                conn.execute(t.delete().where(t.c.expires_at < time.time()))
+
+    def pop(self, key, default=None):
+        t = ConversationState.__table__
+        with self.engine.begin() as conn:
+            if self.engine.dialect.delete_returning:
+                row = conn.execute(t.delete().where(t.c.key == str(key)).returning(t.c.value, t.c.expires_at)).first()
+            else:
+                row = conn.execute(select(t.c.value, t.c.expires_at).where(t.c.key == str(key)).with_for_update()).first()
+                if row is not None and conn.execute(t.delete().where(t.c.key == str(key))).rowcount != 1:
+                    row = None
+        if row is None or row[1] < time.time():
+            return default
+        return json.loads(row[0])
+
+def make_state_store():
+    if STATE_BACKEND == "db":
+        return SqlStateStore(engine)
+    if STATE_BACKEND == "file":
+        return SqlStateStore(create_engine(f"sqlite:///{STATE_FILE}", future=True,
+                                           connect_args={"timeout": 30, "check_same_thread": False}))
+    return MemoryStateStore()
+
+ADMIN_STATE = make_state_store()  # {admin_id: {"mode": "...", ...}}
 
 # --- Helpers ---
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
+@metrics.timed("fn")
 def maintenance_enabled() -> bool:
-    s = SessionLocal()
-    try:
-        val = Setting.get(s, "maintenance", "0")
-        return val == "1"
-    finally:
-        s.close()
+    return settings_cache.get_bool("maintenance")
 
 def set_maintenance(flag: bool):
     s = SessionLocal()
@@ -276,8 +1086,153 @@ def user_tag(u) -> str:
     handle = f"@{u.username}" if u.username else f"id:{u.id}"
     return f"{name} ({handle})"
 
+# 0..35, distinct per bot process sharing a db; unset = lease a free id from the order_nodes table
+ORDER_NODE_ID = int(os.environ["ORDER_NODE_ID"]) if os.getenv("ORDER_NODE_ID", "").strip() else None
+ORDER_NODE_LEASE_SEC = int(os.getenv("ORDER_NODE_LEASE_SEC", "600"))
+WORKER_ID = f"{socket.gethostname()[:40]}:{os.getpid()}:{random.randrange(36 ** 4):04x}"
+BASE36 = string.digits + string.ascii_uppercase
+
+def to_base36(n: int, width: int) -> str:
+    out = []
+    for _ in range(width):
+        n, r = divmod(n, 36)
+        out.append(BASE36[r])
+    return "".join(reversed(out))
+
+class OrderCodeAllocator:
+    """
+    Collision-free, time-sortable order codes without a db round trip:
+    ORD-YYYYMMDD-<node><6 base36 chars of (second_of_day * 1000 + seq)>, 20 chars total.
+    Values only ever increase within a day; a burst past 1000 codes/s borrows the next
+    second's slots instead of repeating one. seed() (at startup, or lazily on the first
+    code) continues after the highest code this node already stored today, so a restart
+    inside a borrowed second cannot hand out a code twice.
+    Without ORDER_NODE_ID the node id is leased from order_nodes (renewed in the
+    background), so processes started with the same configuration never share one.
+    """
+
+    def __init__(self, node_id: int = ORDER_NODE_ID, lease_sec: int = ORDER_NODE_LEASE_SEC, owner: str = WORKER_ID):
+        if node_id is not None and not 0 <= node_id < 36:
+            raise RuntimeError("ORDER_NODE_ID must be between 0 and 35")
+        self.fixed = node_id is not None
+        self.node = BASE36[node_id] if self.fixed else None
+        self.lease = timedelta(seconds=lease_sec)
+        self.owner = owner
+        self.day = None
+        self.last = -1
+        self.seeded = False
+        self.lock = threading.Lock()
+        self.seed_lock = threading.Lock()
+        self.thread = None
+
+    def _claim_node(self) -> int:
+        """Lease the lowest node id that is free or whose holder stopped renewing."""
+        s = SessionLocal()
+        try:
+            now = now_utc()
+            leases = dict(s.execute(select(OrderNode.node_id, OrderNode.lease_until)).all())
+            for n in range(36):
+                if n not in leases:
+                    s.add(OrderNode(node_id=n, owner=self.owner, lease_until=now + self.lease))
+                    try:
+                        s.commit()
+                        return n
+                    except IntegrityError:
+                        s.rollback()  # another process took it first
+                elif as_utc(leases[n]) < now and s.execute(
+                        update(OrderNode).where(OrderNode.node_id == n, OrderNode.lease_until < now)
+                        .values(owner=self.owner, lease_until=now + self.lease)).rowcount == 1:
+                    s.commit()
+                    return n
+                else:
+                    s.rollback()
+        finally:
+            s.close()
+        raise RuntimeError("all 36 order node ids are leased; set ORDER_NODE_ID or wait for stale leases to expire")
+
+    def _renew(self) -> bool:
+        """Extend our node lease; False if it expired and another process took the id."""
+        s = SessionLocal()
+        try:
+            held = s.execute(update(OrderNode)
+                             .where(OrderNode.node_id == BASE36.index(self.node), OrderNode.owner == self.owner)
+                             .values(lease_until=now_utc() + self.lease)).rowcount == 1
+            s.commit()
+            return held
+        except Exception:
+            s.rollback()
+            log.error("Order node lease renewal error: %s", traceback.format_exc())
+            return True  # transient; the lease still has time left
+        finally:
+            s.close()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease.total_seconds() / 3)
+            if not self._renew():
+                log.warning("Order node %s: lease lost, leasing another id", self.node)
+                try:
+                    self.seed(reclaim=True)
+                except Exception:
+                    log.error("Order node re-lease failed: %s", traceback.format_exc())
+
+    def release(self):
+        if self.fixed or self.node is None:
+            return
+        s = SessionLocal()
+        try:
+            s.execute(update(OrderNode)
+                      .where(OrderNode.node_id == BASE36.index(self.node), OrderNode.owner == self.owner)
+                      .values(lease_until=now_utc()))
+            s.commit()
+        except Exception:
+            s.rollback()
+        finally:
+            s.close()
+
+    def seed(self, reclaim: bool = False):
+        with self.seed_lock:
+            if self.seeded and not reclaim:
+                return
+            node = self.node
+            if not self.fixed and (node is None or reclaim):
+                node = BASE36[self._claim_node()]
+                log.info("Order codes: leased node id %s", node)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._heartbeat, name="order-node-lease", daemon=True)
+                    self.thread.start()
+            day = now_utc().strftime("%Y%m%d")
+            prefix = f"ORD-{day}-{node}"
+            s = SessionLocal()
+            try:
+                # fixed-width upper-case base36 sorts as text in numeric order
+                top = s.scalar(select(func.max(Order.order_code)).where(Order.order_code.like(prefix + "%")))
+            finally:
+                s.close()
+            with self.lock:
+                if node != self.node or self.day != day:
+                    self.node, self.day, self.last = node, day, -1
+                if top:
+                    self.last = max(self.last, int(top[len(prefix):], 36))
+                self.seeded = True
+
+    def next(self) -> str:
+        if not self.seeded:
+            self.seed()
+        now = now_utc()
+        day = now.strftime("%Y%m%d")
+        value = (now.hour * 3600 + now.minute * 60 + now.second) * 1000
+        with self.lock:
+            if day != self.day:
+                self.day, self.last = day, -1
+            self.last = max(value, self.last + 1)
+            return f"ORD-{day}-{self.node}{to_base36(self.last, 6)}"
+
+order_codes = OrderCodeAllocator()
+atexit.register(order_codes.release)
+
 def order_code() -> str:
-    return f"ORD-{datetime.utcnow().strftime('%Y%m%d')}-{rand_code(4)}"
+    return order_codes.next()
 
 def human_status(s: str) -> str:
     m = {
@@ -291,6 +1246,49 @@ def human_status(s: str) -> str:
     return m.get(s, s)
 
 # Keyboards
+class PreparedMarkup(types.JsonSerializable):
+    """A reply_markup serialized once; telebot sends to_json() as-is on every request."""
+
+    def __init__(self, markup):
+        self.json = markup.to_json() if isinstance(markup, types.JsonSerializable) else markup
+
+    def to_json(self):
+        return self.json
+
+class KeyboardRegistry:
+    """
+    Keyboards that are identical for every user. Each one is built and serialized once
+    (warm() at startup, or on first use) and every call returns the same PreparedMarkup,
+    so a handler pays a dict lookup instead of building and JSON-encoding a markup graph.
+    The raw builder stays reachable as kb_x.build for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.builders = {}
+        self.prepared = {}
+
+    def static(self, builder):
+        name = builder.__name__
+        self.builders[name] = builder
+
+        @functools.wraps(builder)
+        def get():
+            kb = self.prepared.get(name)
+            if kb is None:
+                kb = self.prepared[name] = PreparedMarkup(builder())  # a racing duplicate is identical
+            return kb
+
+        get.build = builder
+        return get
+
+    def warm(self):
+        for name, builder in self.builders.items():
+            self.prepared[name] = PreparedMarkup(builder())
+        return len(self.prepared)
+
+keyboards = KeyboardRegistry()
+
+@keyboards.static
 def kb_main():
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -302,49 +1300,120 @@ def kb_main():
     )
     return kb
 
+@keyboards.static
 def kb_back_main():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
     return kb
 
-def kb_vpn_menu(session):
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    products = session.query(VpnProduct).filter_by(active=True).order_by(VpnProduct.duration_days, VpnProduct.data_gb).all()
-    for p in products:
-        label = f"Vpn - {p.title} - {format_price_toman(p.price_toman)}"
-        kb.add(types.InlineKeyboardButton(label, callback_data=f"vpn:{p.id}"))
-    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
-    return kb
+class CatalogSnapshot:
+    """Immutable view of the active catalog with ready-to-send menu keyboards."""
+
+    def __init__(self, version: int, session):
+        self.version = version
+        self.vpn = {}    # {id: {"title", "price_toman"}} active products only
+        self.apps = {}   # {id: {"title"}}
+        self.plans = {}  # {id: {"app_id", "app_title", "title", "price_toman"}}
+
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        for p in session.query(VpnProduct).filter_by(active=True).order_by(VpnProduct.duration_days, VpnProduct.data_gb):
+            self.vpn[p.id] = {"title": p.title, "price_toman": p.price_toman}
+            kb.add(types.InlineKeyboardButton(f"Vpn - {p.title} - {format_price_toman(p.price_toman)}", callback_data=f"vpn:{p.id}"))
+        kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
+        self.vpn_menu = PreparedMarkup(kb)
+
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        for a in session.query(App).filter_by(active=True).order_by(App.id):
+            self.apps[a.id] = {"title": a.title}
+            kb.add(types.InlineKeyboardButton(a.title, callback_data=f"app:{a.id}"))
+        kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
+        self.apps_menu = PreparedMarkup(kb)
+
+        plan_kbs = {app_id: types.InlineKeyboardMarkup(row_width=1) for app_id in self.apps}
+        plans = (session.query(AppPlan)
+                 .filter(AppPlan.active == True, AppPlan.app_id.in_(list(self.apps)))
+                 .order_by(AppPlan.app_id, AppPlan.duration_months))
+        for pl in plans:
+            self.plans[pl.id] = {"app_id": pl.app_id, "app_title": self.apps[pl.app_id]["title"],
+                                 "title": pl.title, "price_toman": pl.price_toman}
+            plan_kbs[pl.app_id].add(types.InlineKeyboardButton(f"{pl.title} - {format_price_toman(pl.price_toman)}", callback_data=f"plan:{pl.id}"))
+        self.app_plans = {}
+        for app_id, kb in plan_kbs.items():
+            kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:apps"))
+            self.app_plans[app_id] = PreparedMarkup(kb)
+
+class CatalogCache:
+    """
+    Holds the current CatalogSnapshot. Admin catalog commands call bump() after they
+    commit; the version lives in the settings table so other processes rebuild too.
+    """
+    VERSION_KEY = "catalog_version"
+
+    def __init__(self):
+        self.current = None
+        self.lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        """True when snapshot() (and the settings it reads) can be served without a query."""
+        snap = self.current
+        return (settings_cache.is_fresh() and snap is not None
+                and snap.version == settings_cache.get_int(self.VERSION_KEY, 0))
+
+    def snapshot(self) -> CatalogSnapshot:
+        version = settings_cache.get_int(self.VERSION_KEY, 0)
+        snap = self.current
+        if snap is not None and snap.version == version:
+            return snap
+        with self.lock:
+            if self.current is None or self.current.version != version:
+                s = SessionLocal()
+                try:
+                    self.current = CatalogSnapshot(version, s)
+                finally:
+                    s.close()
+                log.info("Catalog snapshot v%s built", version)
+            return self.current
+
+    def bump(self):
+        s = SessionLocal()
+        try:
+            Setting.increment(s, self.VERSION_KEY)
+            s.commit()
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
 
-def kb_apps_menu(session):
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    apps = session.query(App).filter_by(active=True).order_by(App.id).all()
-    for a in apps:
-        kb.add(types.InlineKeyboardButton(a.title, callback_data=f"app:{a.id}"))
-    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
-    return kb
+catalog = CatalogCache()
 
-def kb_app_plans(session, app_id: int):
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    plans = session.query(AppPlan).filter_by(app_id=app_id, active=True).order_by(AppPlan.duration_months).all()
-    for pl in plans:
-        label = f"{pl.title} - {format_price_toman(pl.price_toman)}"
-        kb.add(types.InlineKeyboardButton(label, callback_data=f"plan:{pl.id}"))
-    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:apps"))
-    return kb
+@metrics.timed("fn")
+def kb_vpn_menu():
+    return catalog.snapshot().vpn_menu
+
+@metrics.timed("fn")
+def kb_apps_menu():
+    return catalog.snapshot().apps_menu
 
+@metrics.timed("fn")
+def kb_app_plans(app_id: int):
+    return catalog.snapshot().app_plans.get(app_id)
+
+@keyboards.static
 def kb_payment():
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("💳 واریز به کارت", callback_data="pay:card"))
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
     return kb
 
+@keyboards.static
 def kb_contact():
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("گفتگو در تلگرام (پی‌وی)", url=support_url()))
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
     return kb
 
+@keyboards.static
 def kb_admin_menu():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -359,15 +1428,15 @@ def kb_admin_menu():
         types.InlineKeyboardButton("🛒 مدیریت VPN", callback_data="adm:mg_vpn"),
         types.InlineKeyboardButton("🛍 مدیریت اپ‌ها", callback_data="adm:mg_apps"),
     )
+    kb.add(types.InlineKeyboardButton("🗂 مرور سفارش‌ها/کاربران/محصولات", callback_data="brw:menu"))
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
     return kb
 
+@keyboards.static
 def kb_broadcast_confirm():
     kb = types.InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        types.InlineKeyboardButton("✅ ارسال به همه", callback_data="adm:bcast_send:all"),
-        types.InlineKeyboardButton("🟢 ارسال به فعال‌های ۳۰ روز", callback_data="adm:bcast_send:active30"),
-    )
+    kb.add(*[types.InlineKeyboardButton(label, callback_data=f"adm:bcast_send:{key}")
+             for key, label in AUDIENCE_SEGMENTS.items()])
     kb.add(types.InlineKeyboardButton("❌ انصراف", callback_data="adm:bcast_cancel"))
     return kb
 
@@ -379,9 +1448,15 @@ def kb_approve_reject(order_id: int):
     )
     return kb
 
-def kb_user_settings(user):
+def kb_claimed(label: str):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton(label, callback_data="noop"))
+    return kb
+
+@metrics.timed("fn")
+def kb_user_settings(allow_broadcast: bool):
     kb = types.InlineKeyboardMarkup(row_width=1)
-    label = "🔔 دریافت پیام‌های همگانی: روشن" if user.allow_broadcast else "🔕 دریافت پیام‌های همگانی: خاموش"
+    label = "🔔 دریافت پیام‌های همگانی: روشن" if allow_broadcast else "🔕 دریافت پیام‌های همگانی: خاموش"
     kb.add(types.InlineKeyboardButton(label, callback_data="usr:toggle_bcast"))
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:home"))
     return kb
@@ -389,34 +1464,131 @@ def kb_user_settings(user):
 # ============================
 # Utilities
 # ============================
-def touch_user(message: Message):
-    s = SessionLocal()
-    try:
-        u = s.get(User, message.from_user.id)
-        if not u:
-            u = User(
-                id=message.from_user.id,
-                username=message.from_user.username,
-                first_name=message.from_user.first_name,
-                last_name=message.from_user.last_name,
-                language_code=message.from_user.language_code,
-                created_at=now_utc(),
-                last_seen_at=now_utc()
+ACTIVITY_FLUSH_MS = int(os.getenv("ACTIVITY_FLUSH_MS", "2000"))
+ACTIVITY_FLUSH_MAX = int(os.getenv("ACTIVITY_FLUSH_MAX", "500"))
+ACTIVITY_SEEN_RESOLUTION = int(os.getenv("ACTIVITY_SEEN_RESOLUTION", "60"))  # seconds
+ACTIVITY_TRACK_MAX = int(os.getenv("ACTIVITY_TRACK_MAX", "100000"))  # users remembered for dedup
+
+PROFILE_FIELDS = ("username", "first_name", "last_name", "language_code")
+
+class ActivityBuffer:
+    """
+    Write-behind buffer for user profile / last_seen_at updates.
+    Touches are merged per user and written with one bulk UPSERT every ACTIVITY_FLUSH_MS
+    or ACTIVITY_FLUSH_MAX entries. A touch that changes nothing (same profile, last_seen
+    within ACTIVITY_SEEN_RESOLUTION of the stored value) is dropped. A user's first touch
+    in this process is written immediately so the row exists for the handlers that follow.
+    Only the ACTIVITY_TRACK_MAX most recently written users are remembered; a user who
+    ages out just gets one extra (idempotent) upsert on their next touch.
+    """
+
+    def __init__(self, flush_ms: int = ACTIVITY_FLUSH_MS, max_entries: int = ACTIVITY_FLUSH_MAX,
+                 max_tracked: int = ACTIVITY_TRACK_MAX):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_entries = max_entries
+        self.max_tracked = max_tracked
+        self.pending = {}   # {uid: row dict}
+        self.flushed = collections.OrderedDict()  # {uid: (profile tuple, last_seen_at)} as last written, LRU
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def touch(self, tg_user, flush: bool = True) -> bool:
+        """Buffer a touch. With flush=False a due flush is not run; True is returned instead."""
+        uid = tg_user.id
+        ts = now_utc()
+        row = {"id": uid, "last_seen_at": ts}
+        for f in PROFILE_FIELDS:
+            row[f] = getattr(tg_user, f, None)
+        profile = tuple(row[f] for f in PROFILE_FIELDS)
+
+        with self.lock:
+            prev = self.flushed.get(uid)
+            if prev and uid not in self.pending and prev[0] == profile \
+                    and (ts - prev[1]).total_seconds() < ACTIVITY_SEEN_RESOLUTION:
+                return False
+            self.pending[uid] = row
+            immediate = prev is None
+            full = len(self.pending) >= self.max_entries
+        self._ensure_thread()
+        if immediate or full:
+            if not flush:
+                return True
+            self.flush()
+        return False
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                rows, self.pending = list(self.pending.values()), {}
+            try:
+                upsert_users(rows)
+            except Exception:
+                # put them back unless a newer touch already replaced them
+                with self.lock:
+                    for r in rows:
+                        self.pending.setdefault(r["id"], r)
+                raise
+            with self.lock:
+                for r in rows:
+                    self.flushed[r["id"]] = (tuple(r[f] for f in PROFILE_FIELDS), r["last_seen_at"])
+                    self.flushed.move_to_end(r["id"])
+                while len(self.flushed) > self.max_tracked:
+                    self.flushed.popitem(last=False)
+            return len(rows)
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._loop, name="activity-flush", daemon=True)
+                    self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.error("Activity flush error: %s", traceback.format_exc())
+
+def upsert_users(rows):
+    """Insert new users / update profile + last_seen_at of existing ones in one statement."""
+    ts = now_utc()
+    values = [dict(r, created_at=ts, allow_broadcast=True, blocked=False) for r in rows]
+
+    def write(s):
+        dialect_insert = upsert_insert()
+        if dialect_insert is not None:
+            stmt = dialect_insert(User).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[User.id],
+                set_={f: stmt.excluded[f] for f in PROFILE_FIELDS + ("last_seen_at",)},
             )
-            s.add(u)
-        else:
-            u.username = message.from_user.username
-            u.first_name = message.from_user.first_name
-            u.last_name = message.from_user.last_name
-            u.language_code = message.from_user.language_code
-            u.last_seen_at = now_utc()
-        s.commit()
-        return u
-    except Exception:
-        s.rollback()
-        raise
-    finally:
-        s.close()
+            s.execute(stmt)
+            return
+        for v in values:
+            u = s.get(User, v["id"])
+            if u is None:
+                s.add(User(**v))
+            else:
+                for f in PROFILE_FIELDS + ("last_seen_at",):
+                    setattr(u, f, v[f])
+
+    db_writer.run(write)
+    audience.seen([(r["id"], r["last_seen_at"]) for r in rows])
+
+activity_buffer = ActivityBuffer()
+atexit.register(lambda: activity_buffer.flush())
+
+@metrics.timed("fn")
+def touch_user(message: Message):
+    """Record activity for the sender (buffered) and return the Telegram user."""
+    activity_buffer.touch(message.from_user)
+    blocked_users.seen(message.from_user.id)
+    return message.from_user
 
 def guard_maintenance(call_or_msg):
     """Return True if interaction must be blocked due to maintenance (unless admin)."""
@@ -425,15 +1597,355 @@ def guard_maintenance(call_or_msg):
         return False
     return maintenance_enabled()
 
-def ensure_order_for_proof(user_id: int):
-    """Fetch latest awaiting_payment order to attach proof."""
+def attach_proof(user_id: int, file_id: str, ptype: str):
+    """
+    Attach a payment proof to the user's latest awaiting_payment order in one short
+    transaction (an index seek on user_id, status, created_at). Returns a plain dict with
+    the fields the admin notification needs, or None; no session outlives this call.
+    """
+    return db_writer.run(attach_proof_job(user_id, file_id, ptype))
+
+def attach_proof_job(user_id: int, file_id: str, ptype: str):
+    def write(s):
+        o = (s.query(Order)
+             .filter(Order.user_id == user_id, Order.status == "awaiting_payment")
+             .order_by(Order.created_at.desc())
+             .limit(1).first())
+        if not o:
+            return None
+        o.payment_proof_file_id = file_id
+        o.payment_proof_type = ptype
+        record_order_transition(s, o, o.status, "proof_submitted")
+        o.status = "proof_submitted"
+        return {"id": o.id, "order_code": o.order_code, "item_title": o.item_title, "price_toman": o.price_toman}
+
+    return write
+
+# ============================
+# Order stats rollup
+# ============================
+INCOME_STATUSES = ("approved", "delivered")
+STATS_ROLLUP_KEY = "stats_rollup_ready"
+
+def record_order_transition(session, order, old_status, new_status):
+    """Apply an order status change to order_stats_daily inside the caller's transaction."""
+    if old_status == new_status:
+        return
+    was_income, is_income = old_status in INCOME_STATUSES, new_status in INCOME_STATUSES
+    if is_income and not was_income:
+        # the segment follows the committed order, not a transaction that may still roll back
+        uid, category, created_at = order.user_id, order.category, order.created_at
+        on_commit(session, lambda: audience.paid_order(uid, category, created_at))
+    delta = {
+        "total": 1 if old_status is None else 0,
+        "approved": int(is_income) - int(was_income),
+        "delivered": int(new_status == "delivered") - int(old_status == "delivered"),
+        "income": (int(is_income) - int(was_income)) * (order.price_toman or 0),
+    }
+    if not any(delta.values()):
+        return
+    day = as_utc(order.created_at or now_utc()).date()
+    dialect_insert = upsert_insert()
+    if dialect_insert is not None:
+        stmt = dialect_insert(OrderStatsDaily).values(day=day, **delta)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[OrderStatsDaily.day],
+            set_={k: getattr(OrderStatsDaily, k) + v for k, v in delta.items()},
+        )
+        session.execute(stmt)
+        return
+    row = session.get(OrderStatsDaily, day)
+    if row is None:
+        session.add(OrderStatsDaily(day=day, **delta))
+    else:
+        for k, v in delta.items():
+            setattr(row, k, getattr(row, k) + v)
+
+def rebuild_order_stats(session):
+    """Recompute the whole rollup from orders with one GROUP BY (first run / repair)."""
+    session.query(OrderStatsDaily).delete()
+    is_income = Order.status.in_(INCOME_STATUSES)
+    rows = (session.query(
+                func.date(Order.created_at),
+                func.count(),
+                func.sum(case((is_income, 1), else_=0)),
+                func.sum(case((Order.status == "delivered", 1), else_=0)),
+                func.sum(case((is_income, Order.price_toman), else_=0)))
+            .group_by(func.date(Order.created_at)).all())
+    for day, total, approved, delivered, income in rows:
+        if day is None:
+            continue
+        if isinstance(day, str):
+            day = datetime.strptime(day, "%Y-%m-%d").date()
+        session.add(OrderStatsDaily(day=day, total=total, approved=approved or 0,
+                                    delivered=delivered or 0, income=income or 0))
+    Setting.set(session, STATS_ROLLUP_KEY, "1")
+
+def order_stats(session, windows):
+    """
+    windows: {name: first_day}. Returns {name: (total, approved, delivered, income)}
+    computed in a single query over the rollup table.
+    """
+    if settings_cache.get(STATS_ROLLUP_KEY) != "1":
+        rebuild_order_stats(session)
+        session.commit()
+    cols = []
+    for start in windows.values():
+        in_window = OrderStatsDaily.day >= start
+        for metric in ("total", "approved", "delivered", "income"):
+            cols.append(func.coalesce(func.sum(case((in_window, getattr(OrderStatsDaily, metric)), else_=0)), 0))
+    row = session.query(*cols).filter(OrderStatsDaily.day >= min(windows.values())).one()
+    return {name: tuple(row[i * 4:(i + 1) * 4]) for i, name in enumerate(windows)}
+
+# ============================
+# Streaming CSV export
+# ============================
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_GZIP = os.getenv("EXPORT_GZIP", "0") == "1"
+
+EXPORTS = {
+    # name: (header, columns, keyset column, descending, date column)
+    "users": (
+        ["user_id", "username", "first_name", "last_name", "allow_broadcast", "blocked", "created_at", "last_seen_at"],
+        [User.id, User.username, User.first_name, User.last_name, User.allow_broadcast, User.blocked, User.created_at, User.last_seen_at],
+        User.id, False, User.created_at,
+    ),
+    "orders": (
+        ["order_id", "order_code", "user_id", "category", "item_title", "price_toman", "status", "approved_by", "created_at", "updated_at"],
+        [Order.id, Order.order_code, Order.user_id, Order.category, Order.item_title, Order.price_toman, Order.status, Order.approved_by_admin_id, Order.created_at, Order.updated_at],
+        Order.id, True, Order.created_at,
+    ),
+}
+
+def keyset_page(columns, key_col, filters=(), after=None, descending=False, limit=EXPORT_PAGE_SIZE):
+    """One page of column tuples: WHERE key > after ORDER BY key LIMIT n (key must be columns[0])."""
+    q = select(*columns).where(*filters)
+    if after is not None:
+        q = q.where(key_col < after if descending else key_col > after)
+    q = q.order_by(key_col.desc() if descending else key_col).limit(limit)
     s = SessionLocal()
     try:
-        o = s.query(Order).filter_by(user_id=user_id, status="awaiting_payment").order_by(Order.created_at.desc()).first()
-        return (s, o)  # caller must close/commit
-    except Exception:
+        return s.execute(q).all()
+    finally:
         s.close()
-        raise
+
+def iter_keyset(columns, key_col, filters=(), descending=False, page_size=EXPORT_PAGE_SIZE):
+    """Yield column tuples page by page; each page is its own short session."""
+    last = None
+    while True:
+        rows = keyset_page(columns, key_col, filters, last, descending, page_size)
+        if not rows:
+            return
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1][0]
+
+def export_csv(name: str, date_from=None, date_to=None, status=None, gz: bool = EXPORT_GZIP):
+    """Write an export to a temp file in pages; returns (open file positioned at 0, file name, row count)."""
+    header, columns, key_col, descending, date_col = EXPORTS[name]
+    filters = []
+    if date_from:
+        filters.append(date_col >= date_from)
+    if date_to:
+        filters.append(date_col < date_to)
+    if status and name == "orders":
+        filters.append(Order.status == status)
+
+    tmp = tempfile.TemporaryFile()
+    raw = gzip.GzipFile(fileobj=tmp, mode="wb") if gz else tmp
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    w = csv.writer(out)
+    w.writerow(header)
+    count = 0
+    for row in iter_keyset(columns, key_col, filters, descending):
+        w.writerow(["" if v is None else int(v) if isinstance(v, bool) else v for v in row])
+        count += 1
+    out.flush()
+    out.detach()
+    if gz:
+        raw.close()  # writes the gzip trailer, leaves tmp open
+    tmp.seek(0)
+    return tmp, f"{name}.csv" + (".gz" if gz else ""), count
+
+def parse_export_args(text: str):
+    """
+    '/export_orders 2025-01-01 2025-02-01 approved gz' -> (from, to, status, gz).
+    Raises ValueError for a token that looks like a date but is not one (e.g. 2024-13-01),
+    rather than filtering on it as a status.
+    """
+    dates, status, gz = [], None, EXPORT_GZIP
+    for tok in (text or "").split()[1:]:
+        if tok == "gz":
+            gz = True
+            continue
+        if tok[:1].isdigit():
+            try:
+                dates.append(datetime.strptime(tok, "%Y-%m-%d").replace(tzinfo=timezone.utc))
+            except ValueError:
+                raise ValueError(f"تاریخ نامعتبر: {tok}") from None
+            if len(dates) > 2:
+                raise ValueError("حداکثر دو تاریخ (از / تا) مجاز است.")
+        else:
+            status = tok
+    return (dates[0] if dates else None), (dates[1] if len(dates) > 1 else None), status, gz
+
+def send_export(chat_id: int, name: str, date_from=None, date_to=None, status=None, gz: bool = EXPORT_GZIP):
+    captions = {"users": "📤 خروجی کاربران", "orders": "📤 خروجی سفارش‌ها"}
+    f, filename, count = export_csv(name, date_from, date_to, status, gz)
+    try:
+        bot.send_document(chat_id, f, caption=f"{captions[name]} ({count})", visible_file_name=filename)
+    finally:
+        f.close()
+
+# ============================
+# Audience segments (broadcast targets)
+# ============================
+AUDIENCE_CHUNK = int(os.getenv("AUDIENCE_CHUNK", "5000"))
+AUDIENCE_REBUILD_SEC = int(os.getenv("AUDIENCE_REBUILD_SEC", "900"))   # full re-scan, catches other processes' writes
+AUDIENCE_LAPSED_DAYS = int(os.getenv("AUDIENCE_LAPSED_DAYS", "45"))    # no paid order for this long = lapsed
+CATEGORY_BITS = {"vpn": 1, "app": 2}
+
+AUDIENCE_SEGMENTS = {
+    "all": "✅ همه",
+    "active30": "🟢 فعال‌های ۳۰ روز",
+    "buyers": "🛒 خریداران",
+    "nonbuyers": "🆕 بدون خرید",
+    "vpn": "🔐 مشتریان VPN",
+    "app": "📱 مشتریان اپ",
+    "lapsed": f"⏳ بدون تمدید ({AUDIENCE_LAPSED_DAYS} روز)",
+}
+
+class AudienceIndex:
+    """
+    In-memory id sets for broadcast segments, so picking an audience never loads User rows.
+    Built by streaming (id, allow_broadcast, blocked, last_seen_at) in keyset chunks plus one
+    grouped scan of paid orders, then kept current by the write paths that change them
+    (activity upserts, blocked-user flushes, broadcast toggle, order transitions). A full
+    rebuild runs in the background every AUDIENCE_REBUILD_SEC; updates that arrive while it
+    runs are journaled and replayed on the new sets, so nothing is lost in the swap.
+    Telegram ids are sparse 64-bit values, so sets/arrays are used rather than bitmaps.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.eligible = set()   # allow_broadcast and not blocked
+        self.last_seen = {}     # uid -> epoch seconds (every known user)
+        self.paid = {}          # uid -> [last paid order epoch, CATEGORY_BITS mask]
+        self.built_at = 0.0
+        self.journal = None     # list of pending ops while a rebuild is running
+
+    # --- incremental updates (all idempotent, so journal replay is safe) ---
+    def _apply(self, op, *args):
+        with self.lock:
+            if not self.built_at and self.journal is None:
+                return  # not built yet; the first build reads the database anyway
+            if self.journal is not None:
+                self.journal.append((op, args))
+            op(*args)
+
+    def _seen(self, rows):
+        for uid, ts in rows:
+            if uid not in self.last_seen:
+                self.eligible.add(uid)  # new users are inserted with allow_broadcast=True
+            self.last_seen[uid] = ts
+
+    def _set_eligible(self, ids, flag):
+        if flag:
+            self.eligible.update(ids)
+        else:
+            self.eligible.difference_update(ids)
+
+    def _paid(self, uid, category, ts):
+        entry = self.paid.setdefault(uid, [0.0, 0])
+        entry[0] = max(entry[0], ts)
+        entry[1] |= CATEGORY_BITS.get(category, 0)
+
+    def seen(self, rows):
+        """rows: [(uid, last_seen datetime)] just upserted."""
+        self._apply(self._seen, [(uid, as_utc(ts).timestamp()) for uid, ts in rows])
+
+    def set_eligible(self, ids, flag: bool):
+        self._apply(self._set_eligible, list(ids), flag)
+
+    def paid_order(self, uid: int, category: str, created_at):
+        self._apply(self._paid, uid, category, as_utc(created_at or now_utc()).timestamp())
+
+    # --- full build ---
+    def build(self):
+        with self.lock:
+            if self.journal is not None:
+                return  # another build is running
+            self.journal = []
+        started = time.perf_counter()
+        try:
+            eligible, last_seen, paid = set(), {}, {}
+            for uid, allow, blocked, seen_at in iter_keyset(
+                    [User.id, User.allow_broadcast, User.blocked, User.last_seen_at], User.id, page_size=AUDIENCE_CHUNK):
+                last_seen[uid] = as_utc(seen_at).timestamp() if seen_at else 0.0
+                if allow and not blocked:
+                    eligible.add(uid)
+            q = (select(Order.user_id, Order.category, func.max(Order.created_at))
+                 .where(Order.status.in_(INCOME_STATUSES)).group_by(Order.user_id, Order.category))
+            s = SessionLocal()
+            try:
+                for uid, category, last in s.execute(q.execution_options(yield_per=AUDIENCE_CHUNK)):
+                    entry = paid.setdefault(uid, [0.0, 0])
+                    entry[0] = max(entry[0], as_utc(last).timestamp() if last else 0.0)
+                    entry[1] |= CATEGORY_BITS.get(category, 0)
+            finally:
+                s.close()
+        except Exception:
+            with self.lock:
+                self.journal = None
+            raise
+        with self.lock:
+            self.eligible, self.last_seen, self.paid = eligible, last_seen, paid
+            for op, args in self.journal:
+                op(*args)
+            self.journal = None
+            self.built_at = time.monotonic()
+        log.info("Audience index built: %d users, %d eligible, %d buyers in %.2fs",
+                 len(last_seen), len(eligible), len(paid), time.perf_counter() - started)
+
+    def ensure(self):
+        if not self.built_at:
+            self.build()
+        elif time.monotonic() - self.built_at > AUDIENCE_REBUILD_SEC and self.journal is None:
+            threading.Thread(target=self._rebuild_quietly, name="audience-rebuild", daemon=True).start()
+
+    def _rebuild_quietly(self):
+        try:
+            self.build()
+        except Exception:
+            log.error("Audience rebuild error: %s", traceback.format_exc())
+
+    def select(self, segment: str):
+        """Sorted array of user ids in the segment."""
+        self.ensure()
+        now = time.time()
+        with self.lock:
+            eligible, paid = self.eligible, self.paid
+            if segment == "all":
+                ids = eligible
+            elif segment == "active30":
+                cutoff = now - 30 * 86400
+                ids = [u for u in eligible if self.last_seen.get(u, 0.0) >= cutoff]
+            elif segment == "buyers":
+                ids = eligible.intersection(paid)
+            elif segment == "nonbuyers":
+                ids = eligible.difference(paid)
+            elif segment in CATEGORY_BITS:
+                bit = CATEGORY_BITS[segment]
+                ids = [u for u in eligible.intersection(paid) if paid[u][1] & bit]
+            elif segment == "lapsed":
+                cutoff = now - AUDIENCE_LAPSED_DAYS * 86400
+                ids = [u for u in eligible.intersection(paid) if paid[u][0] < cutoff]
+            else:
+                raise ValueError(f"unknown segment {segment!r}")
+            return array("q", sorted(ids))
+
+audience = AudienceIndex()
 
 # ============================
 # Command Handlers
@@ -451,353 +1963,950 @@ def cmd_id(message: Message):
     touch_user(message)
     bot.reply_to(message, f"🆔 ID شما: <code>{message.from_user.id}</code>")
 
+@bot.message_handler(commands=["perf"])
+def cmd_perf(message: Message):
+    if not is_admin(message.from_user.id): return
+    t = transport.stats()
+    bot.send_message(message.chat.id, f"<pre>{metrics.report()}\n\nBot API: {t['requests']} requests over "
+                                      f"{t['connections']} connections ({t['reuse']:.0%} reused), {t['retries']} retries</pre>")
+
 # ============================
-# Callback Handlers (Navigation & Actions)
+# Admin notifications
 # ============================
-@bot.callback_query_handler(func=lambda c: True)
-def on_callback(call: CallbackQuery):
-    try:
-        data = call.data or ""
-        uid = call.from_user.id
-
-        # Maintenance gate (except some items & admins)
-        if not data.startswith("nav:") and not is_admin(uid) and maintenance_enabled():
-            bot.answer_callback_query(call.id, "ربات در حال تعمیرات است.", show_alert=True)
-            return
-
-        bot.answer_callback_query(call.id)
-
-        if data == "nav:home":
-            bot.edit_message_text("از منو یکی را انتخاب کنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_main()); return
-
-        if data == "nav:vpn":
-            s = SessionLocal()
-            try:
-                bot.edit_message_text("🛡️ خرید VPN — پلن مورد نظر را انتخاب کنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_vpn_menu(s))
-            finally:
-                s.close()
-            return
-
-        if data.startswith("vpn:"):
-            vpn_id = int(data.split(":")[1])
-            s = SessionLocal()
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_RETRIES = int(os.getenv("NOTIFY_RETRIES", "3"))
+NOTIFY_TRACK_MAX = int(os.getenv("NOTIFY_TRACK_MAX", "5000"))  # orders whose admin copies are remembered
+
+class AdminNotifier:
+    """
+    Sends payment-proof notifications to all admins in parallel with retries.
+    Remembers which message each admin got per order, so once one admin approves or
+    rejects, the buttons on everyone else's copy are replaced with who handled it.
+    Only the newest NOTIFY_TRACK_MAX orders are remembered; receipts nobody reviews
+    (or that leave proof_submitted some other way) age out instead of piling up.
+    """
+
+    def __init__(self, bot, workers: int = NOTIFY_WORKERS, retries: int = NOTIFY_RETRIES,
+                 max_tracked: int = NOTIFY_TRACK_MAX):
+        self.bot = bot
+        self.retries = retries
+        self.max_tracked = max_tracked
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+        self.messages = collections.OrderedDict()  # {order_id: {admin_id: message_id}}, oldest first
+        self.lock = threading.Lock()
+
+    def _call(self, fn, *args, **kwargs):
+        for attempt in range(self.retries + 1):
             try:
-                p = s.get(VpnProduct, vpn_id)
-                if not p or not p.active:
-                    bot.answer_callback_query(call.id, "این محصول موجود نیست.", show_alert=True); return
-                o = Order(
-                    order_code=order_code(),
-                    user_id=uid,
-                    category="vpn",
-                    item_title=f"VPN — {p.title}",
-                    price_toman=p.price_toman,
-                    vpn_product_id=p.id,
-                    status="awaiting_payment",
-                )
-                s.add(o); s.commit()
-                bot.edit_message_text(
-                    f"✅ «{o.item_title}» انتخاب شد.\n"
-                    f"کد سفارش: <code>{o.order_code}</code>\n\n"
-                    f"برای ادامه پرداخت:",
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    reply_markup=kb_payment()
-                )
+                return fn(*args, **kwargs)
+            except ApiException as e:
+                retry_after = retry_after_of(e)
+                if attempt == self.retries or is_blocked_error(e):
+                    raise
+                time.sleep(retry_after if retry_after is not None else 0.5 * (2 ** attempt))
             except Exception:
-                s.rollback(); raise
-            finally:
-                s.close()
-            return
+                if attempt == self.retries:
+                    raise
+                time.sleep(0.5 * (2 ** attempt))
 
-        if data == "nav:apps":
-            s = SessionLocal()
-            try:
-                bot.edit_message_text("🛍️ اشتراک اپ‌ها — یک اپ را انتخاب کنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_apps_menu(s))
-            finally:
-                s.close()
-            return
+    def notify_proof(self, order_id: int, ptype: str, file_id: str, caption: str):
+        for admin_id in ADMIN_IDS:
+            self.executor.submit(self._send_proof, admin_id, order_id, ptype, file_id, caption)
 
-        if data.startswith("app:"):
-            app_id = int(data.split(":")[1])
-            s = SessionLocal()
-            try:
-                a = s.get(App, app_id)
-                if not a or not a.active:
-                    bot.answer_callback_query(call.id, "این اپ فعال نیست.", show_alert=True); return
-                bot.edit_message_text(f"{a.title}\nیک پلن را انتخاب کنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_app_plans(s, a.id))
-            finally:
-                s.close()
+    def _send_proof(self, admin_id, order_id, ptype, file_id, caption):
+        send = self.bot.send_photo if ptype == "photo" else self.bot.send_document
+        try:
+            msg = self._call(send, admin_id, file_id, caption=caption, reply_markup=kb_approve_reject(order_id))
+        except Exception as e:
+            log.warning("Proof notification to admin %s failed: %s", admin_id, e)
             return
+        with self.lock:
+            self.messages.setdefault(order_id, {})[admin_id] = msg.message_id
+            while len(self.messages) > self.max_tracked:
+                self.messages.popitem(last=False)
+
+    def mark_handled(self, order_id: int, by_admin: int, label: str):
+        """Replace approve/reject buttons on the other admins' copies of this receipt."""
+        with self.lock:
+            copies = self.messages.pop(order_id, {})
+        markup = kb_claimed(f"{label} — ادمین {by_admin}")
+        for admin_id, message_id in copies.items():
+            if admin_id != by_admin:
+                self.executor.submit(self._call, self.bot.edit_message_reply_markup,
+                                     admin_id, message_id, reply_markup=markup)
+
+admin_notifier = AdminNotifier(bot)
 
-        if data.startswith("plan:"):
-            plan_id = int(data.split(":")[1])
-            s = SessionLocal()
-            try:
-                pl = s.get(AppPlan, plan_id)
-                if not pl or not pl.active:
-                    bot.answer_callback_query(call.id, "این پلن فعال نیست.", show_alert=True); return
-                o = Order(
-                    order_code=order_code(),
-                    user_id=uid,
-                    category="app",
-                    item_title=f"{pl.app.title} — {pl.title}",
-                    price_toman=pl.price_toman,
-                    app_plan_id=pl.id,
-                    status="awaiting_payment",
-                )
-                s.add(o); s.commit()
-                bot.edit_message_text(
-                    f"✅ {o.item_title}\n"
-                    f"کد سفارش: <code>{o.order_code}</code>\n\n"
-                    f"برای ادامه پرداخت:",
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    reply_markup=kb_payment()
-                )
-            except Exception:
-                s.rollback(); raise
-            finally:
-                s.close()
-            return
+# ============================
+# Order placement
+# ============================
+def place_order_job(uid: int, category: str, item_title: str, price_toman: int,
+                    vpn_product_id: int = None, app_plan_id: int = None):
+    """(order code, db_writer job) for a new awaiting_payment order."""
+    code = order_code()
+
+    def write(s):
+        o = Order(order_code=code, user_id=uid, category=category, item_title=item_title,
+                  price_toman=price_toman, vpn_product_id=vpn_product_id, app_plan_id=app_plan_id,
+                  status="awaiting_payment", created_at=now_utc())
+        s.add(o)
+        record_order_transition(s, o, None, o.status)
+        s.flush()
+
+    return code, write
+
+def place_order(uid: int, category: str, item_title: str, price_toman: int,
+                vpn_product_id: int = None, app_plan_id: int = None) -> str:
+    """
+    Insert an awaiting_payment order in one short transaction and return its code.
+    Product data comes from the catalog snapshot and the code from OrderCodeAllocator,
+    so the only statements are the order INSERT and the stats rollup UPSERT.
+    """
+    code, write = place_order_job(uid, category, item_title, price_toman, vpn_product_id, app_plan_id)
+    db_writer.run(write)
+    return code
+
+def vpn_order_spec(product_id: int):
+    """place_order arguments for an active VPN product, or None."""
+    p = catalog.snapshot().vpn.get(product_id)
+    if not p:
+        return None
+    return {"category": "vpn", "item_title": f"VPN — {p['title']}", "price_toman": p["price_toman"],
+            "vpn_product_id": product_id}
+
+def plan_order_spec(plan_id: int):
+    """place_order arguments for an active app plan, or None."""
+    pl = catalog.snapshot().plans.get(plan_id)
+    if not pl:
+        return None
+    return {"category": "app", "item_title": f"{pl['app_title']} — {pl['title']}", "price_toman": pl["price_toman"],
+            "app_plan_id": plan_id}
+
+def order_placed_text(spec: dict, code: str) -> str:
+    head = f"✅ «{spec['item_title']}» انتخاب شد." if spec["category"] == "vpn" else f"✅ {spec['item_title']}"
+    return (f"{head}\n"
+            f"کد سفارش: <code>{code}</code>\n\n"
+            f"برای ادامه پرداخت:")
 
-        if data == "pay:card":
-            msg = (f"💳 شماره کارت برای واریز:\n<code>{CARD_NUMBER}</code>\n\n"
-                   "✅ پس از پرداخت، لطفاً اسکرین‌شات/رسید تراکنش را <b>همینجا</b> ارسال کنید.\n"
-                   "ℹ️ حتماً کد سفارش درج‌شده در گفت‌وگو را نزد خود نگه دارید.")
-            bot.send_message(call.message.chat.id, msg)
+# ============================
+# Callback router
+# ============================
+class CallbackContext:
+    """Per-callback state: parsed args, a lazily opened session and answer-once helpers."""
+
+    def __init__(self, call: CallbackQuery, route: str, args):
+        self.call = call
+        self.uid = call.from_user.id
+        self.route = route
+        self.args = args
+        self.answered = False
+        self._session = None
+
+    @property
+    def chat_id(self) -> int:
+        return self.call.message.chat.id
+
+    @property
+    def message_id(self) -> int:
+        return self.call.message.message_id
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = SessionLocal()
+        return self._session
+
+    def int_arg(self, i: int = 0) -> int:
+        return int(self.args[i])
+
+    def answer(self, text: str = None, alert: bool = False):
+        """Answer the callback query once; later calls are no-ops."""
+        if self.answered:
             return
-
-        if data == "nav:support":
-            bot.edit_message_text("📞 تماس با پشتیبانی\nبرای گفتگو مستقیم با پشتیبان، روی دکمه زیر بزنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_contact()); return
-
-        if data == "nav:settings":
-            s = SessionLocal()
-            try:
-                u = s.get(User, uid)
-                bot.edit_message_text("⚙️ تنظیمات حساب:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_user_settings(u))
-            finally:
-                s.close()
+        self.answered = True
+        bot.answer_callback_query(self.call.id, text, show_alert=alert)
+
+    def alert(self, text: str):
+        self.answer(text, alert=True)
+
+    def edit(self, text: str, reply_markup=None):
+        bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup)
+
+    def close(self, failed: bool = False):
+        if self._session is not None:
+            if failed:
+                self._session.rollback()
+            self._session.close()
+            self._session = None
+
+class CallbackRouter:
+    """
+    Dict-based callback dispatch. Data is "<ns>:<action>[:args...]" or "<ns>[:args...]";
+    a route registered as "ns:action" wins over "ns". Lookup is two dict probes, args are
+    split once, and each route's latency is recorded in metrics.
+    """
+
+    def __init__(self):
+        self.routes = {}   # key -> (handler, admin_only)
+
+    def route(self, key: str, admin: bool = False):
+        def deco(fn):
+            self.routes[key] = (fn, admin)
+            return fn
+        return deco
+
+    def resolve(self, data: str):
+        parts = data.split(":")
+        if len(parts) > 1:
+            key = f"{parts[0]}:{parts[1]}"
+            if key in self.routes:
+                return key, parts[2:]
+        if parts[0] in self.routes:
+            return parts[0], parts[1:]
+        return None, parts
+
+    def record(self, key: str, elapsed: float):
+        metrics.observe("callback", key, elapsed)
+
+    def dispatch(self, call: CallbackQuery):
+        data = call.data or ""
+        key, args = self.resolve(data)
+        if key is None:
+            bot.answer_callback_query(call.id)
             return
-
-        if data == "usr:toggle_bcast":
-            s = SessionLocal()
+        handler, admin_only = self.routes[key]
+        ctx = CallbackContext(call, key, args)
+        started = time.perf_counter()
+        failed = False
+        try:
+            # Maintenance gate (except navigation & admins)
+            if not key.startswith("nav") and not is_admin(ctx.uid) and maintenance_enabled():
+                ctx.alert("ربات در حال تعمیرات است.")
+                return
+            if admin_only and not is_admin(ctx.uid):
+                ctx.alert("دسترسی ندارید.")
+                return
+            handler(ctx)
+            ctx.answer()
+        except Exception:
+            failed = True
+            log.error("Callback error (%s): %s", key, traceback.format_exc())
             try:
-                u = s.get(User, uid)
-                u.allow_broadcast = not u.allow_broadcast
-                s.commit()
-                bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=kb_user_settings(u))
-                bot.answer_callback_query(call.id, "تنظیم شد.", show_alert=False)
+                ctx.answered = False
+                ctx.alert("خطا رخ داد.")
             except Exception:
-                s.rollback(); raise
-            finally:
-                s.close()
-            return
-
-        # Admin panel
-        if data == "nav:admin":
-            if not is_admin(uid):
-                bot.answer_callback_query(call.id, "دسترسی ندارید.", show_alert=True); return
-            bot.edit_message_text("🔐 پنل ادمین — یک گزینه را انتخاب کنید:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb_admin_menu()); return
+                pass
+        finally:
+            ctx.close(failed)
+            self.record(key, time.perf_counter() - started)
 
-        if data.startswith("adm:"):
-            if not is_admin(uid):
-                bot.answer_callback_query(call.id, "دسترسی ندارید.", show_alert=True); return
-            action = data.split(":")[1]
+router = CallbackRouter()
 
-            s = SessionLocal()
+# ============================
+# Update guard (per-user rate limit, callback de-duplication)
+# ============================
+GUARD_USER_RATE = float(os.getenv("GUARD_USER_RATE", "2"))        # sustained updates/sec per user (0 = off)
+GUARD_USER_BURST = float(os.getenv("GUARD_USER_BURST", "8"))
+GUARD_COALESCE_MS = float(os.getenv("GUARD_COALESCE_MS", "1500"))  # same user + same callback data within this window
+GUARD_MAX_TRACKED = int(os.getenv("GUARD_MAX_TRACKED", "50000"))   # LRU bound on users / callback keys kept
+
+class UpdateGuard:
+    """
+    Runs before any handler. Callback queries are dropped when their id was already seen
+    (webhook redelivery), when the same user sent the same data within GUARD_COALESCE_MS
+    (double taps on vpn:<id> or adm:approve), or when the user's TokenBucket is empty.
+    Messages only go through the rate limit. Admins are never rate limited, but their
+    double taps are still coalesced. Each update is checked once, even when the async
+    runtime hands it on to the sync bot.
+    """
+
+    def __init__(self, rate: float = GUARD_USER_RATE, burst: float = GUARD_USER_BURST,
+                 coalesce_ms: float = GUARD_COALESCE_MS, max_tracked: int = GUARD_MAX_TRACKED):
+        self.rate = rate
+        self.burst = burst
+        self.window = coalesce_ms / 1000.0
+        self.max_tracked = max_tracked
+        self.buckets = collections.OrderedDict()   # uid -> TokenBucket, least recently active first
+        self.recent = collections.OrderedDict()    # (uid, data) -> monotonic time of the last accepted tap
+        self.call_ids = collections.OrderedDict()  # callback ids already handled
+        self.lock = threading.Lock()
+
+    def _limited(self, uid: int) -> bool:
+        if not self.rate or is_admin(uid):
+            return False
+        with self.lock:
+            b = self.buckets.get(uid)
+            if b is None:
+                b = self.buckets[uid] = TokenBucket(self.rate, capacity=self.burst)
+                if len(self.buckets) > self.max_tracked:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(uid)
+        return b.try_acquire() > 0
+
+    def _drop(self, kind: str, reason: str) -> str:
+        metrics.inc("updates_dropped_total", kind=kind, reason=reason)
+        return reason
+
+    def check_callback(self, call: CallbackQuery):
+        """None if the callback may run, else "duplicate" | "coalesced" | "rate"."""
+        if getattr(call, "guard_checked", False):
+            return None
+        call.guard_checked = True
+        now = time.monotonic()
+        key = (call.from_user.id, call.data)
+        with self.lock:
+            if call.id in self.call_ids:
+                return self._drop("callback", "duplicate")
+            self.call_ids[call.id] = None
+            if len(self.call_ids) > self.max_tracked:
+                self.call_ids.popitem(last=False)
+            last = self.recent.get(key)
+            if last is not None and now - last < self.window:
+                return self._drop("callback", "coalesced")
+            self.recent[key] = now
+            self.recent.move_to_end(key)
+            while self.recent and (len(self.recent) > self.max_tracked
+                                   or now - next(iter(self.recent.values())) >= self.window):
+                self.recent.popitem(last=False)
+        if self._limited(call.from_user.id):
+            return self._drop("callback", "rate")
+        return None
+
+    def check_message(self, message: Message):
+        """None if the message may be handled, else "rate"."""
+        if getattr(message, "guard_checked", False):
+            return None
+        message.guard_checked = True
+        if self._limited(message.from_user.id):
+            return self._drop("message", "rate")
+        return None
+
+update_guard = UpdateGuard()
+
+GUARD_SLOW_DOWN = "⏳ لطفاً کمی آهسته‌تر؛ چند ثانیه بعد دوباره امتحان کنید."
+
+class UpdateGuardMiddleware(BaseMiddleware):
+    update_sensitive = True
+    update_types = ["message", "callback_query"]
+
+    def pre_process_message(self, message, data):
+        if update_guard.check_message(message):
+            return CancelUpdate()
+
+    def pre_process_callback_query(self, call, data):
+        reason = update_guard.check_callback(call)
+        if not reason:
+            return None
+        if reason != "duplicate":  # a redelivered id was answered the first time
             try:
-                if action == "users_count":
-                    total = s.query(User).count()
-                    active30 = s.query(User).filter(User.last_seen_at >= now_utc() - timedelta(days=30)).count()
-                    bot.send_message(call.message.chat.id, f"👥 تعداد کاربران: {total}\n🟢 فعال ۳۰ روز اخیر: {active30}")
-                    return
-
-                if action == "export_users":
-                    buf = io.StringIO(); w = csv.writer(buf)
-                    w.writerow(["user_id","username","first_name","last_name","allow_broadcast","blocked","created_at","last_seen_at"])
-                    for u in s.query(User).order_by(User.id).all():
-                        w.writerow([u.id, u.username or "", u.first_name or "", u.last_name or "", int(u.allow_broadcast), int(u.blocked), u.created_at, u.last_seen_at])
-                    datafile = io.BytesIO(buf.getvalue().encode("utf-8")); datafile.name = "users.csv"
-                    bot.send_document(call.message.chat.id, datafile, caption="📤 خروجی کاربران")
-                    return
-
-                if action == "export_orders":
-                    buf = io.StringIO(); w = csv.writer(buf)
-                    w.writerow(["order_id","order_code","user_id","category","item_title","price_toman","status","approved_by","created_at","updated_at"])
-                    for o in s.query(Order).order_by(Order.created_at.desc()).all():
-                        w.writerow([o.id, o.order_code, o.user_id, o.category, o.item_title, o.price_toman, o.status, o.approved_by_admin_id or "", o.created_at, o.updated_at])
-                    datafile = io.BytesIO(buf.getvalue().encode("utf-8")); datafile.name = "orders.csv"
-                    bot.send_document(call.message.chat.id, datafile, caption="📤 خروجی سفارش‌ها")
-                    return
-
-                if action == "maintenance":
-                    cur = maintenance_enabled()
-                    set_maintenance(not cur)
-                    status = "فعال شد ✅" if not cur else "غیرفعال شد ❌"
-                    bot.send_message(call.message.chat.id, f"🛠 حالت تعمیرات {status}")
-                    return
-
-                if action == "stats":
-                    today = now_utc().date()
-                    start_today = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
-                    start_7d = now_utc() - timedelta(days=7)
-                    start_month = datetime(now_utc().year, now_utc().month, 1, tzinfo=timezone.utc)
-
-                    def agg(start):
-                        q = s.query(Order).filter(Order.created_at >= start)
-                        total = q.count()
-                        approved = q.filter(Order.status.in_(["approved","delivered"])).count()
-                        delivered = q.filter(Order.status == "delivered").count()
-                        income = sum(x.price_toman for x in q.filter(Order.status.in_(["approved","delivered"])).all())
-                        return total, approved, delivered, income
-
-                    t_total, t_approved, t_delivered, t_income = agg(start_today)
-                    w_total, w_appr, w_deliv, w_income = agg(start_7d)
-                    m_total, m_appr, m_deliv, m_income = agg(start_month)
-
-                    msg = (f"📊 آمار\n\n"
-                           f"📅 امروز:\n"
-                           f"• کل سفارش‌ها: {t_total}\n"
-                           f"• تأیید/تحویل: {t_approved}/{t_delivered}\n"
-                           f"• درآمد: {format_price_toman(t_income)}\n\n"
-                           f"🗓 ۷ روز اخیر:\n"
-                           f"• کل: {w_total} | تأیید: {w_appr} | تحویل: {w_deliv}\n"
-                           f"• درآمد: {format_price_toman(w_income)}\n\n"
-                           f"🗓 ماه جاری:\n"
-                           f"• کل: {m_total} | تأیید: {m_appr} | تحویل: {m_deliv}\n"
-                           f"• درآمد: {format_price_toman(m_income)}")
-                    bot.send_message(call.message.chat.id, msg)
-                    return
-
-                if action == "mg_vpn":
-                    products = s.query(VpnProduct).order_by(VpnProduct.id).all()
-                    lines = ["🛒 محصولات VPN:"]
-                    for p in products:
-                        lines.append(f"• #{p.id} — {p.title} — {format_price_toman(p.price_toman)} — {'✅' if p.active else '❌'}")
-                    lines.append("\n➕ برای افزودن/ویرایش، دستور زیر را بفرستید:")
-                    lines.append("<code>/add_vpn عنوان | روز | گیگ | قیمت_تومان</code>")
-                    lines.append("<code>/edit_vpn ID | عنوان | روز | گیگ | قیمت_تومان | active(0/1)</code>")
-                    lines.append("<code>/del_vpn ID</code>")
-                    bot.send_message(call.message.chat.id, "\n".join(lines))
-                    return
-
-                if action == "mg_apps":
-                    apps = s.query(App).order_by(App.id).all()
-                    lines = ["🛍 اپ‌ها و پلن‌ها:"]
-                    for a in apps:
-                        lines.append(f"• #{a.id} — {a.title} ({a.key}) — {'✅' if a.active else '❌'}")
-                        for pl in a.plans:
-                            lines.append(f"   └ plan #{pl.id} — {pl.title} — {pl.duration_months or '-'} ماه — {format_price_toman(pl.price_toman)} — {'✅' if pl.active else '❌'}")
-                    lines += [
-                        "\n➕ مدیریت اپ/پلن با دستورات:",
-                        "<code>/add_app key | عنوان</code>",
-                        "<code>/edit_app ID | key | عنوان | active(0/1)</code>",
-                        "<code>/del_app ID</code>",
-                        "<code>/add_plan app_id | عنوان | ماه | قیمت_تومان</code>",
-                        "<code>/edit_plan ID | عنوان | ماه | قیمت_تومان | active(0/1)</code>",
-                        "<code>/del_plan ID</code>",
-                    ]
-                    bot.send_message(call.message.chat.id, "\n".join(lines))
-                    return
-
-                if action == "broadcast":
-                    ADMIN_STATE[uid] = {"mode": "await_broadcast_draft"}
-                    bot.send_message(call.message.chat.id, "📣 لطفاً محتوای پیام همگانی را ارسال کنید (متن/عکس/ویدیو/سند...). سپس گزینهٔ ارسال را می‌بینید.")
-                    return
-
-                if action == "bcast_send":
-                    bot.answer_callback_query(call.id, "از دکمهٔ مربوط به سگمنت استفاده کنید.", show_alert=True)
-                    return
-
-                # Approve / Reject / Broadcast confirm with segment
-                if action == "approve":
-                    order_id = int(data.split(":")[2])
-                    o = s.get(Order, order_id)
-                    if not o:
-                        bot.answer_callback_query(call.id, "سفارش یافت نشد.", show_alert=True); return
-                    o.status = "approved"
-                    o.approved_by_admin_id = uid
-                    s.commit()
-
-                    # Prompt admin for delivery message
-                    ADMIN_STATE[uid] = {"mode": "await_delivery", "order_id": o.id}
-                    bot.send_message(call.message.chat.id, f"✅ سفارش {o.order_code} تأیید شد.\nلطفاً پیام «تحویل» را ارسال کنید تا برای کاربر ارسال شود (می‌تواند متن/فایل باشد).")
-                    # Notify user
-                    bot.send_message(o.user_id, f"✅ رسید پرداخت شما برای سفارش <code>{o.order_code}</code> تأیید شد.\nبه‌زودی اطلاعات سرویس برای شما ارسال می‌شود.")
-                    return
-
-                if action == "reject":
-                    order_id = int(data.split(":")[2])
-                    o = s.get(Order, order_id)
-                    if not o:
-                        bot.answer_callback_query(call.id, "سفارش یافت نشد.", show_alert=True); return
-                    o.status = "rejected"
-                    o.approved_by_admin_id = uid
-                    s.commit()
-                    ADMIN_STATE[uid] = {"mode": "await_reject_reason", "order_id": o.id}
-                    bot.send_message(call.message.chat.id, f"❌ سفارش {o.order_code} رد شد.\nلطفاً دلیل رد را ارسال کنید تا برای کاربر نمایش داده شود.")
-                    return
-
-                if action == "bcast_send":
-                    # not used — legacy
-                    return
+                bot.answer_callback_query(call.id, GUARD_SLOW_DOWN if reason == "rate" else None)
+            except ApiException as e:
+                log.debug("Guard answer failed: %s", e)
+        return CancelUpdate()
 
-            finally:
-                s.close()
+    def post_process_message(self, message, data, exception):
+        pass
 
-        # Broadcast confirm with segment: adm:bcast_send:all or :active30
-        if data.startswith("adm:bcast_send:"):
-            if not is_admin(uid):
-                bot.answer_callback_query(call.id, "دسترسی ندارید.", show_alert=True); return
+    def post_process_callback_query(self, call, data, exception):
+        pass
 
-            st = ADMIN_STATE.get(uid)
-            if not st or st.get("mode") != "broadcast_ready":
-                bot.answer_callback_query(call.id, "پیش‌نویسی وجود ندارد.", show_alert=True); return
+bot.setup_middleware(UpdateGuardMiddleware())
 
-            segment = data.split(":")[2]
-            draft = st["draft"]  # {"from_chat_id": int, "message_id": int}
-            from_chat_id = draft["from_chat_id"]
-            message_id = draft["message_id"]
+# ============================
+# Callback Handlers (Navigation & Actions)
+# ============================
+@router.route("nav:home")
+def cb_home(ctx):
+    ctx.edit("از منو یکی را انتخاب کنید:", kb_main())
+
+@router.route("nav:vpn")
+def cb_vpn_menu(ctx):
+    ctx.edit("🛡️ خرید VPN — پلن مورد نظر را انتخاب کنید:", kb_vpn_menu())
+
+@router.route("vpn")
+def cb_vpn_order(ctx):
+    spec = vpn_order_spec(ctx.int_arg())
+    if not spec:
+        ctx.alert("این محصول موجود نیست."); return
+    code = place_order(ctx.uid, **spec)
+    ctx.edit(order_placed_text(spec, code), kb_payment())
+
+@router.route("nav:apps")
+def cb_apps_menu(ctx):
+    ctx.edit("🛍️ اشتراک اپ‌ها — یک اپ را انتخاب کنید:", kb_apps_menu())
+
+@router.route("app")
+def cb_app(ctx):
+    app_id = ctx.int_arg()
+    a = catalog.snapshot().apps.get(app_id)
+    if not a:
+        ctx.alert("این اپ فعال نیست."); return
+    ctx.edit(f"{a['title']}\nیک پلن را انتخاب کنید:", kb_app_plans(app_id))
+
+@router.route("plan")
+def cb_plan_order(ctx):
+    spec = plan_order_spec(ctx.int_arg())
+    if not spec:
+        ctx.alert("این پلن فعال نیست."); return
+    code = place_order(ctx.uid, **spec)
+    ctx.edit(order_placed_text(spec, code), kb_payment())
+
+PAY_CARD_TEXT = (f"💳 شماره کارت برای واریز:\n<code>{CARD_NUMBER}</code>\n\n"
+                 "✅ پس از پرداخت، لطفاً اسکرین‌شات/رسید تراکنش را <b>همینجا</b> ارسال کنید.\n"
+                 "ℹ️ حتماً کد سفارش درج‌شده در گفت‌وگو را نزد خود نگه دارید.")
+
+@router.route("pay:card")
+def cb_pay_card(ctx):
+    bot.send_message(ctx.chat_id, PAY_CARD_TEXT)
+
+@router.route("nav:support")
+def cb_support(ctx):
+    ctx.edit("📞 تماس با پشتیبانی\nبرای گفتگو مستقیم با پشتیبان، روی دکمه زیر بزنید:", kb_contact())
+
+@router.route("nav:settings")
+def cb_settings(ctx):
+    allow = ctx.session.scalar(select(User.allow_broadcast).where(User.id == ctx.uid))
+    ctx.edit("⚙️ تنظیمات حساب:", kb_user_settings(allow is not False))
+
+def toggle_broadcast_stmt(uid: int):
+    return (update(User).where(User.id == uid)
+            .values(allow_broadcast=case((User.allow_broadcast == False, True), else_=False)))
+
+@router.route("usr:toggle_bcast")
+def cb_toggle_bcast(ctx):
+    s = ctx.session
+    stmt = toggle_broadcast_stmt(ctx.uid)
+    if engine.dialect.update_returning:
+        row = s.execute(stmt.returning(User.allow_broadcast, User.blocked)).first()
+    else:
+        s.execute(stmt)
+        row = s.execute(select(User.allow_broadcast, User.blocked).where(User.id == ctx.uid)).first()
+    s.commit()
+    if row is None:
+        ctx.alert("ابتدا /start را بزنید."); return
+    allow, blocked = row
+    audience.set_eligible([ctx.uid], allow and not blocked)
+    bot.edit_message_reply_markup(ctx.chat_id, ctx.message_id, reply_markup=kb_user_settings(allow))
+    ctx.answer("تنظیم شد.")
+
+# Admin panel
+@router.route("nav:admin", admin=True)
+def cb_admin(ctx):
+    ctx.edit("🔐 پنل ادمین — یک گزینه را انتخاب کنید:", kb_admin_menu())
+
+@router.route("adm:users_count", admin=True)
+def cb_users_count(ctx):
+    s = ctx.session
+    total = s.scalar(select(func.count(User.id)))
+    active30 = s.scalar(select(func.count(User.id)).where(User.last_seen_at >= now_utc() - timedelta(days=30)))
+    bot.send_message(ctx.chat_id, f"👥 تعداد کاربران: {total}\n🟢 فعال ۳۰ روز اخیر: {active30}")
+
+@router.route("adm:export_users", admin=True)
+def cb_export_users(ctx):
+    ctx.answer()
+    send_export(ctx.chat_id, "users")
+
+@router.route("adm:export_orders", admin=True)
+def cb_export_orders(ctx):
+    ctx.answer()
+    send_export(ctx.chat_id, "orders")
+
+@router.route("adm:maintenance", admin=True)
+def cb_maintenance(ctx):
+    cur = maintenance_enabled()
+    set_maintenance(not cur)
+    status = "فعال شد ✅" if not cur else "غیرفعال شد ❌"
+    bot.send_message(ctx.chat_id, f"🛠 حالت تعمیرات {status}")
+
+@router.route("adm:stats", admin=True)
+def cb_stats(ctx):
+    today = now_utc().date()
+    stats = order_stats(ctx.session, {
+        "today": today,
+        "7d": today - timedelta(days=6),
+        "month": today.replace(day=1),
+    })
+    t_total, t_approved, t_delivered, t_income = stats["today"]
+    w_total, w_appr, w_deliv, w_income = stats["7d"]
+    m_total, m_appr, m_deliv, m_income = stats["month"]
+
+    msg = (f"📊 آمار\n\n"
+           f"📅 امروز:\n"
+           f"• کل سفارش‌ها: {t_total}\n"
+           f"• تأیید/تحویل: {t_approved}/{t_delivered}\n"
+           f"• درآمد: {format_price_toman(t_income)}\n\n"
+           f"🗓 ۷ روز اخیر:\n"
+           f"• کل: {w_total} | تأیید: {w_appr} | تحویل: {w_deliv}\n"
+           f"• درآمد: {format_price_toman(w_income)}\n\n"
+           f"🗓 ماه جاری:\n"
+           f"• کل: {m_total} | تأیید: {m_appr} | تحویل: {m_deliv}\n"
+           f"• درآمد: {format_price_toman(m_income)}")
+    bot.send_message(ctx.chat_id, msg)
+
+@router.route("adm:mg_vpn", admin=True)
+def cb_mg_vpn(ctx):
+    products = ctx.session.query(VpnProduct).order_by(VpnProduct.id).all()
+    lines = ["🛒 محصولات VPN:"]
+    for p in products:
+        lines.append(f"• #{p.id} — {p.title} — {format_price_toman(p.price_toman)} — {'✅' if p.active else '❌'}")
+    lines.append("\n➕ برای افزودن/ویرایش، دستور زیر را بفرستید:")
+    lines.append("<code>/add_vpn عنوان | روز | گیگ | قیمت_تومان</code>")
+    lines.append("<code>/edit_vpn ID | عنوان | روز | گیگ | قیمت_تومان | active(0/1)</code>")
+    lines.append("<code>/del_vpn ID</code>")
+    bot.send_message(ctx.chat_id, "\n".join(lines))
+
+@router.route("adm:mg_apps", admin=True)
+def cb_mg_apps(ctx):
+    apps = ctx.session.query(App).options(selectinload(App.plans)).order_by(App.id).all()
+    lines = ["🛍 اپ‌ها و پلن‌ها:"]
+    for a in apps:
+        lines.append(f"• #{a.id} — {a.title} ({a.key}) — {'✅' if a.active else '❌'}")
+        for pl in a.plans:
+            lines.append(f"   └ plan #{pl.id} — {pl.title} — {pl.duration_months or '-'} ماه — {format_price_toman(pl.price_toman)} — {'✅' if pl.active else '❌'}")
+    lines += [
+        "\n➕ مدیریت اپ/پلن با دستورات:",
+        "<code>/add_app key | عنوان</code>",
+        "<code>/edit_app ID | key | عنوان | active(0/1)</code>",
+        "<code>/del_app ID</code>",
+        "<code>/add_plan app_id | عنوان | ماه | قیمت_تومان</code>",
+        "<code>/edit_plan ID | عنوان | ماه | قیمت_تومان | active(0/1)</code>",
+        "<code>/del_plan ID</code>",
+    ]
+    bot.send_message(ctx.chat_id, "\n".join(lines))
+
+@router.route("adm:broadcast", admin=True)
+def cb_broadcast(ctx):
+    ADMIN_STATE.set(ctx.uid, {"mode": "await_broadcast_draft"})
+    bot.send_message(ctx.chat_id, "📣 لطفاً محتوای پیام همگانی را ارسال کنید (متن/عکس/ویدیو/سند...). سپس گزینهٔ ارسال را می‌بینید.")
+
+REVIEWABLE_STATUSES = ("awaiting_payment", "proof_submitted")
+
+def claim_order(s, order_id: int, admin_id: int, new_status: str):
+    """
+    Move a reviewable order to new_status on behalf of admin_id with one conditional
+    UPDATE, so of two admins (or processes) tapping at once exactly one wins.
+    Returns (order, won). The stats rollup is applied only by the winner.
+    """
+    o = s.get(Order, order_id)
+    if o is None or o.status not in REVIEWABLE_STATUSES:
+        return o, False
+    old_status = o.status
+    claimed = s.execute(
+        update(Order)
+        .where(Order.id == order_id, Order.status.in_(REVIEWABLE_STATUSES))
+        .values(status=new_status, approved_by_admin_id=admin_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    if not claimed:
+        s.rollback()  # expires o, so the caller sees the winner's row
+        return o, False
+    record_order_transition(s, o, old_status, new_status)
+    return o, True
+
+def already_reviewed(ctx, o):
+    if o is None:
+        ctx.alert("سفارش یافت نشد.")
+    elif o.approved_by_admin_id is not None:
+        ctx.alert(f"این سفارش قبلاً توسط ادمین {o.approved_by_admin_id} بررسی شده است.")
+    else:
+        ctx.alert(f"این سفارش در وضعیت «{human_status(o.status)}» است.")
+
+@router.route("noop")
+def cb_noop(ctx):
+    pass
+
+@router.route("adm:approve", admin=True)
+def cb_approve(ctx):
+    s = ctx.session
+    o, won = claim_order(s, ctx.int_arg(), ctx.uid, "approved")
+    if not won:
+        already_reviewed(ctx, o); return
+    order_id, code, user_id = o.id, o.order_code, o.user_id  # read before commit expires o
+    s.commit()
+    admin_notifier.mark_handled(order_id, ctx.uid, "✅ تأیید شد")
+
+    # Prompt admin for delivery message
+    ADMIN_STATE.set(ctx.uid, {"mode": "await_delivery", "order_id": order_id})
+    bot.send_message(ctx.chat_id, f"✅ سفارش {code} تأیید شد.\nلطفاً پیام «تحویل» را ارسال کنید تا برای کاربر ارسال شود (می‌تواند متن/فایل باشد).")
+    # Notify user
+    bot.send_message(user_id, f"✅ رسید پرداخت شما برای سفارش <code>{code}</code> تأیید شد.\nبه‌زودی اطلاعات سرویس برای شما ارسال می‌شود.")
+
+@router.route("adm:reject", admin=True)
+def cb_reject(ctx):
+    s = ctx.session
+    o, won = claim_order(s, ctx.int_arg(), ctx.uid, "rejected")
+    if not won:
+        already_reviewed(ctx, o); return
+    order_id, code = o.id, o.order_code
+    s.commit()
+    admin_notifier.mark_handled(order_id, ctx.uid, "❌ رد شد")
+    ADMIN_STATE.set(ctx.uid, {"mode": "await_reject_reason", "order_id": order_id})
+    bot.send_message(ctx.chat_id, f"❌ سفارش {code} رد شد.\nلطفاً دلیل رد را ارسال کنید تا برای کاربر نمایش داده شود.")
+
+# Broadcast confirm with segment: adm:bcast_send:<AUDIENCE_SEGMENTS key>
+@router.route("adm:bcast_send", admin=True)
+def cb_bcast_send(ctx):
+    if not ctx.args:
+        ctx.alert("از دکمهٔ مربوط به سگمنت استفاده کنید."); return
+    segment = ctx.args[0]
+    if segment not in AUDIENCE_SEGMENTS:
+        ctx.alert("سگمنت نامعتبر."); return
+    # pop = atomic claim, so a double tap (or a second process) can't enqueue the draft twice
+    st = ADMIN_STATE.pop(ctx.uid)
+    if not st or st.get("mode") != "broadcast_ready":
+        if st:
+            ADMIN_STATE.set(ctx.uid, st)
+        ctx.alert("پیش‌نویسی وجود ندارد."); return
+
+    draft = st["draft"]  # {"from_chat_id": int, "message_id": int}
+    targets = audience.select(segment)
+    ctx.answer()
+
+    ctx.edit(f"⏳ ارسال همگانی به {len(targets)} کاربر در صف قرار گرفت…")
+    enqueue_broadcast(ctx.uid, draft, segment, targets, ctx.chat_id, ctx.message_id)
+
+@router.route("adm:bcast_cancel", admin=True)
+@router.route("adm:broadcast_cancel", admin=True)
+def cb_bcast_cancel(ctx):
+    ADMIN_STATE.pop(ctx.uid, None)
+    ctx.edit("❌ ارسال همگانی لغو شد.")
 
-            s = SessionLocal()
-            try:
-                if segment == "all":
-                    target_q = s.query(User).filter(User.allow_broadcast == True)
-                elif segment == "active30":
-                    target_q = s.query(User).filter(User.allow_broadcast == True, User.last_seen_at >= now_utc() - timedelta(days=30))
-                else:
-                    bot.answer_callback_query(call.id, "سگمنت نامعتبر.", show_alert=True); return
+# ============================
+# Admin browser (keyset pagination; callback data: brw:<kind>:<filter>:<cursor>)
+# ============================
+BROWSE_PAGE = int(os.getenv("BROWSE_PAGE", "10"))
+BROWSE_STATUSES = ["proof_submitted", "awaiting_payment", "approved", "delivered", "rejected", "all"]
 
-                targets = [u.id for u in target_q.all()]
-            finally:
-                s.close()
+def kb_browse_page(rows, item_cb, next_cb, first_cb):
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for label, data in rows:
+        kb.add(types.InlineKeyboardButton(label, callback_data=item_cb.format(data) if item_cb else "noop"))
+    nav = []
+    if first_cb:
+        nav.append(types.InlineKeyboardButton("⏮ اول", callback_data=first_cb))
+    if next_cb:
+        nav.append(types.InlineKeyboardButton("بعدی ▶️", callback_data=next_cb))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="brw:menu"))
+    return kb
 
-            sent_ok, sent_fail = broadcast_copy(draft, targets)
-            # log in db
-            s = SessionLocal()
-            try:
-                s.add(BroadcastLog(admin_id=uid, from_chat_id=from_chat_id, message_id=message_id, segment=segment, sent_ok=sent_ok, sent_fail=sent_fail))
-                s.commit()
-            finally:
-                s.close()
+def browse_cursor(ctx, i: int):
+    return int(ctx.args[i]) if len(ctx.args) > i and ctx.args[i] else None
 
-            ADMIN_STATE.pop(uid, None)
-            bot.edit_message_text(f"✅ ارسال همگانی پایان یافت.\nموفق: {sent_ok}\nناموفق: {sent_fail}", chat_id=call.message.chat.id, message_id=call.message.message_id)
-            return
+@router.route("brw:menu", admin=True)
+def cb_browse_menu(ctx):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(*[types.InlineKeyboardButton(f"🧾 {human_status(st) if st != 'all' else 'همه سفارش‌ها'}", callback_data=f"brw:o:{st}:")
+             for st in BROWSE_STATUSES])
+    kb.add(types.InlineKeyboardButton("👥 کاربران", callback_data="brw:u:"),
+           types.InlineKeyboardButton("🛒 محصولات VPN", callback_data="brw:pv:"),
+           types.InlineKeyboardButton("🛍 پلن‌های اپ", callback_data="brw:pp:"))
+    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="nav:admin"))
+    ctx.edit("🗂 مرور — یک بخش را انتخاب کنید:", kb)
+
+@router.route("brw:o", admin=True)
+def cb_browse_orders(ctx):
+    status, after = ctx.args[0], browse_cursor(ctx, 1)
+    filters = [] if status == "all" else [Order.status == status]
+    rows = keyset_page([Order.id, Order.order_code, Order.price_toman, Order.status], Order.id,
+                       filters, after, descending=True, limit=BROWSE_PAGE + 1)
+    more, rows = len(rows) > BROWSE_PAGE, rows[:BROWSE_PAGE]
+    items = [(f"#{r.id} {r.order_code} — {format_price_toman(r.price_toman)} — {human_status(r.status)}", r.id) for r in rows]
+    title = human_status(status) if status != "all" else "همه"
+    ctx.edit(f"🧾 سفارش‌ها ({title})" + ("" if rows else "\n— موردی نیست —"),
+             kb_browse_page(items, "brw:od:{}",
+                            f"brw:o:{status}:{rows[-1].id}" if more else None,
+                            f"brw:o:{status}:" if after else None))
+
+@router.route("brw:od", admin=True)
+def cb_browse_order_detail(ctx):
+    o = ctx.session.get(Order, ctx.int_arg())
+    if not o:
+        ctx.alert("سفارش یافت نشد."); return
+    text = (f"🧾 سفارش #{o.id}\n"
+            f"کد: <code>{o.order_code}</code>\n"
+            f"کاربر: <code>{o.user_id}</code>\n"
+            f"سفارش: {o.item_title}\n"
+            f"قیمت: {format_price_toman(o.price_toman)}\n"
+            f"وضعیت: {human_status(o.status)}\n"
+            f"زمان: {o.created_at}")
+    markup = kb_approve_reject(o.id) if o.status == "proof_submitted" else None
+    if o.payment_proof_file_id:
+        send = bot.send_photo if o.payment_proof_type == "photo" else bot.send_document
+        send(ctx.chat_id, o.payment_proof_file_id, caption=text, reply_markup=markup)
+    else:
+        bot.send_message(ctx.chat_id, text, reply_markup=markup)
+
+@router.route("brw:u", admin=True)
+def cb_browse_users(ctx):
+    after = browse_cursor(ctx, 0)
+    rows = keyset_page([User.id, User.username, User.first_name, User.blocked], User.id,
+                       (), after, limit=BROWSE_PAGE + 1)
+    more, rows = len(rows) > BROWSE_PAGE, rows[:BROWSE_PAGE]
+    items = [(f"{r.id} — {('@' + r.username) if r.username else (r.first_name or '')}{' 🚫' if r.blocked else ''}", r.id) for r in rows]
+    ctx.edit("👥 کاربران" + ("" if rows else "\n— موردی نیست —"),
+             kb_browse_page(items, "brw:ud:{}", f"brw:u:{rows[-1].id}" if more else None, "brw:u:" if after else None))
+
+BROWSE_USER_ORDERS = 10
+
+@router.route("brw:ud", admin=True)
+def cb_browse_user_detail(ctx):
+    # admin view: the order history is wanted here, so load it eagerly in one extra query
+    u = ctx.session.get(User, ctx.int_arg(), options=[selectinload(User.orders)])
+    if not u:
+        ctx.alert("کاربر یافت نشد."); return
+    orders = sorted(u.orders, key=lambda o: o.id, reverse=True)
+    paid = sum(o.price_toman or 0 for o in orders if o.status in INCOME_STATUSES)
+    lines = [f"👤 کاربر <code>{u.id}</code> — {user_tag(u)}",
+             f"عضویت: {u.created_at:%Y-%m-%d} | آخرین بازدید: {u.last_seen_at:%Y-%m-%d}" if u.created_at and u.last_seen_at else "",
+             f"پیام همگانی: {'روشن' if u.allow_broadcast else 'خاموش'}{' | 🚫 مسدود کرده' if u.blocked else ''}",
+             f"سفارش‌ها: {len(orders)} | پرداخت‌شده: {format_price_toman(paid)}"]
+    lines += [f"• <code>{o.order_code}</code> — {o.item_title} — {human_status(o.status)}" for o in orders[:BROWSE_USER_ORDERS]]
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="brw:u"))
+    ctx.edit("\n".join(l for l in lines if l), kb)
+
+@router.route("brw:pv", admin=True)
+def cb_browse_vpn(ctx):
+    after = browse_cursor(ctx, 0)
+    rows = keyset_page([VpnProduct.id, VpnProduct.title, VpnProduct.price_toman, VpnProduct.active], VpnProduct.id,
+                       (), after, limit=BROWSE_PAGE + 1)
+    more, rows = len(rows) > BROWSE_PAGE, rows[:BROWSE_PAGE]
+    items = [(f"#{r.id} {r.title} — {format_price_toman(r.price_toman)} {'✅' if r.active else '❌'}", r.id) for r in rows]
+    ctx.edit("🛒 محصولات VPN", kb_browse_page(items, None, f"brw:pv:{rows[-1].id}" if more else None, "brw:pv:" if after else None))
+
+@router.route("brw:pp", admin=True)
+def cb_browse_plans(ctx):
+    after = browse_cursor(ctx, 0)
+    rows = keyset_page([AppPlan.id, AppPlan.app_id, AppPlan.title, AppPlan.price_toman, AppPlan.active], AppPlan.id,
+                       (), after, limit=BROWSE_PAGE + 1)
+    more, rows = len(rows) > BROWSE_PAGE, rows[:BROWSE_PAGE]
+    items = [(f"#{r.id} app {r.app_id} — {r.title} — {format_price_toman(r.price_toman)} {'✅' if r.active else '❌'}", r.id) for r in rows]
+    ctx.edit("🛍 پلن‌های اپ", kb_browse_page(items, None, f"brw:pp:{rows[-1].id}" if more else None, "brw:pp:" if after else None))
 
-        if data == "adm:broadcast_cancel":
-            if not is_admin(uid):
-                bot.answer_callback_query(call.id, "دسترسی ندارید.", show_alert=True); return
-            ADMIN_STATE.pop(uid, None)
-            bot.edit_message_text("❌ ارسال همگانی لغو شد.", chat_id=call.message.chat.id, message_id=call.message.message_id)
-            return
+@bot.callback_query_handler(func=lambda c: True)
+def on_callback(call: CallbackQuery):
+    router.dispatch(call)
 
-    except Exception as e:
-        log.error("Callback error: %s", traceback.format_exc())
+# ============================
+# Bulk catalog import / export
+# ============================
+CATALOG_IMPORT_MAX_BYTES = 1 << 20
+CATALOG_CSV_HEADER = ["type", "id", "app_key", "key", "title", "duration", "data_gb", "price_toman", "active"]
+
+def _int_or_none(v):
+    return None if v is None or str(v).strip() == "" else int(v)
+
+def _bool(v):
+    if isinstance(v, bool):
+        return v
+    text_ = str(v).strip().lower()
+    if text_ in ("1", "true", "yes", "y"):
+        return True
+    if text_ in ("0", "false", "no", "n"):
+        return False
+    raise ValueError(f"active must be 1/0, true/false or yes/no, got {v!r}")
+
+def _blank(v) -> bool:
+    return v is None or str(v).strip() == ""
+
+def _text(v) -> str:
+    if _blank(v):
+        raise ValueError("empty text")
+    return str(v).strip()
+
+# fields where a blank cell means "keep the current value" (new rows: default or "missing")
+CATALOG_OPTIONAL_BLANK = ("app_id", "active", "title", "key")
+
+# type -> (model, {field: parser}); "duration" in CSV maps to duration_days / duration_months
+CATALOG_MODELS = {
+    "vpn": (VpnProduct, {"title": _text, "duration_days": int, "data_gb": _int_or_none, "price_toman": int, "active": _bool}),
+    "app": (App, {"key": _text, "title": _text, "active": _bool}),
+    "plan": (AppPlan, {"app_id": _int_or_none, "title": _text, "duration_months": _int_or_none, "price_toman": int, "active": _bool}),
+}
+
+def catalog_export(session, fmt: str = "json"):
+    """Whole catalog as (bytes, filename); the output is a valid import file."""
+    apps = session.query(App).order_by(App.id).all()
+    app_keys = {a.id: a.key for a in apps}
+    plans = session.query(AppPlan).order_by(AppPlan.app_id, AppPlan.id).all()
+    vpn = session.query(VpnProduct).order_by(VpnProduct.id).all()
+    if fmt == "csv":
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(CATALOG_CSV_HEADER)
+        for p in vpn:
+            w.writerow(["vpn", p.id, "", "", p.title, p.duration_days, "" if p.data_gb is None else p.data_gb, p.price_toman, int(bool(p.active))])
+        for a in apps:
+            w.writerow(["app", a.id, "", a.key, a.title, "", "", "", int(bool(a.active))])
+        for pl in plans:
+            w.writerow(["plan", pl.id, app_keys.get(pl.app_id, ""), "", pl.title, "" if pl.duration_months is None else pl.duration_months, "", pl.price_toman, int(bool(pl.active))])
+        return buf.getvalue().encode("utf-8"), "catalog.csv"
+    by_app = collections.defaultdict(list)
+    for pl in plans:
+        by_app[pl.app_id].append({"id": pl.id, "title": pl.title, "duration_months": pl.duration_months,
+                                  "price_toman": pl.price_toman, "active": bool(pl.active)})
+    doc = {
+        "vpn": [{"id": p.id, "title": p.title, "duration_days": p.duration_days, "data_gb": p.data_gb,
+                 "price_toman": p.price_toman, "active": bool(p.active)} for p in vpn],
+        "apps": [{"id": a.id, "key": a.key, "title": a.title, "active": bool(a.active), "plans": by_app.get(a.id, [])}
+                 for a in apps],
+    }
+    return json.dumps(doc, ensure_ascii=False, indent=1).encode("utf-8"), "catalog.json"
+
+def parse_catalog_file(filename: str, raw: bytes):
+    """Normalize a JSON or CSV catalog file into [{"type", "id", ..., "app_key"?}] rows."""
+    rows = []
+    if filename.lower().endswith(".json"):
+        doc = json.loads(raw.decode("utf-8-sig"))
+        for p in doc.get("vpn", []):
+            rows.append(dict(p, type="vpn"))
+        for a in doc.get("apps", []):
+            plans = a.get("plans", [])
+            rows.append({k: v for k, v in a.items() if k != "plans"} | {"type": "app"})
+            for pl in plans:
+                rows.append(dict(pl, type="plan", app_id=a.get("id"), app_key=a.get("key")))
+        return rows
+    for r in csv.DictReader(io.StringIO(raw.decode("utf-8-sig"))):
+        t = (r.get("type") or "").strip()
+        row = {"type": t, "id": r.get("id"), "title": r.get("title"), "active": r.get("active")}
+        if t == "vpn":
+            row.update(duration_days=r.get("duration"), data_gb=r.get("data_gb"), price_toman=r.get("price_toman"))
+        elif t == "app":
+            row.update(key=r.get("key"))
+        elif t == "plan":
+            row.update(app_key=r.get("app_key"), duration_months=r.get("duration"), price_toman=r.get("price_toman"))
+        rows.append(row)
+    return rows
+
+def apply_catalog(session, rows, dry_run: bool = False):
+    """
+    Validate rows, diff them against the db and apply creates/updates in the caller's
+    transaction. Rows are never deleted (set active=0 instead; orders reference them).
+    Returns (summary dict, errors list); nothing is written if there are errors.
+    """
+    errors = []
+    parsed = []
+    for i, r in enumerate(rows, 1):
+        t = r.get("type")
+        if t not in CATALOG_MODELS:
+            errors.append(f"row {i}: unknown type {t!r}")
+            continue
+        _, fields = CATALOG_MODELS[t]
         try:
-            bot.answer_callback_query(call.id, "خطا رخ داد.", show_alert=True)
-        except Exception:
-            pass
+            # a blank cell means "no change"; new rows default to active and need title/key
+            values = {f: fn(r[f]) for f, fn in fields.items()
+                      if f in r and not (f in CATALOG_OPTIONAL_BLANK and _blank(r[f]))}
+            row_id = _int_or_none(r.get("id"))
+        except (TypeError, ValueError) as e:
+            errors.append(f"row {i}: {e}")
+            continue
+        if row_id is None:
+            missing = [f for f in fields if f not in values and f not in ("active", "data_gb", "duration_months", "app_id")]
+            if missing:
+                errors.append(f"row {i}: missing {', '.join(missing)}")
+                continue
+        if values.get("price_toman", 0) < 0:
+            errors.append(f"row {i}: negative price")
+            continue
+        if t == "plan" and row_id is None and "app_id" not in values and not r.get("app_key"):
+            errors.append(f"row {i}: plan needs app_id or app_key")
+            continue
+        parsed.append((t, row_id, values, r.get("app_key")))
+    if errors:
+        return None, errors
+
+    summary = {"created": 0, "updated": 0, "unchanged": 0}
+    existing = {t: {o.id: o for o in session.query(model)} for t, (model, _) in CATALOG_MODELS.items()}
+    app_ids_by_key = {a.key: a.id for a in existing["app"].values()}
+    natural_key = lambda t, v: v.get("key") if t == "app" else (v.get("app_id"), v.get("title")) if t == "plan" else v.get("title")
+    natural = {(t, natural_key(t, {c: getattr(o, c) for c in ("key", "app_id", "title") if hasattr(o, c)})): o
+               for t, objs in existing.items() for o in objs.values()}
+    # apps first so plans can point at apps created by the same file
+    for t, row_id, values, app_key in sorted(parsed, key=lambda x: x[0] != "app"):
+        model = CATALOG_MODELS[t][0]
+        if t == "plan" and "app_id" not in values:
+            if app_key not in app_ids_by_key:
+                errors.append(f"plan {values.get('title')!r}: unknown app_key {app_key!r}")
+                continue
+            values["app_id"] = app_ids_by_key[app_key]
+        if row_id is not None:
+            obj = existing[t].get(row_id)
+            if obj is None:
+                errors.append(f"{t} #{row_id}: not found")
+                continue
+        else:
+            # id-less rows match on their natural key so re-importing a file is idempotent
+            obj = natural.get((t, natural_key(t, values)))
+        if obj is None:
+            obj = model(**values)
+            if t != "app":
+                obj.active = values.get("active", True)
+            session.add(obj)
+            natural[(t, natural_key(t, values))] = obj
+            summary["created"] += 1
+            if t == "app":
+                session.flush()
+                app_ids_by_key[obj.key] = obj.id
+            continue
+        changed = {f: v for f, v in values.items() if getattr(obj, f) != v}
+        if not changed:
+            summary["unchanged"] += 1
+            continue
+        for f, v in changed.items():
+            setattr(obj, f, v)
+        summary["updated"] += 1
+    if errors:
+        return None, errors
+    if dry_run:
+        session.rollback()
+    return summary, []
+
+@bot.message_handler(commands=["export_catalog"])
+def export_catalog(message: Message):
+    if not is_admin(message.from_user.id): return
+    fmt = "csv" if "csv" in message.text.split()[1:] else "json"
+    s = SessionLocal()
+    try:
+        data, filename = catalog_export(s, fmt)
+    finally:
+        s.close()
+    f = io.BytesIO(data); f.name = filename
+    bot.send_document(message.chat.id, f, caption="📦 خروجی کاتالوگ — ویرایش کنید و با کپشن /import_catalog بفرستید.")
+
+@bot.message_handler(content_types=["document"],
+                     func=lambda m: is_admin(m.from_user.id) and (m.caption or "").startswith("/import_catalog"))
+def import_catalog(message: Message):
+    dry_run = "dry" in message.caption.split()[1:]
+    doc = message.document
+    if (doc.file_size or 0) > CATALOG_IMPORT_MAX_BYTES:
+        bot.reply_to(message, "❌ فایل خیلی بزرگ است."); return
+    try:
+        raw = bot.download_file(bot.get_file(doc.file_id).file_path)
+        rows = parse_catalog_file(doc.file_name or "catalog.csv", raw)
+    except Exception as e:
+        bot.reply_to(message, f"❌ فایل قابل خواندن نیست: {e}"); return
+
+    s = SessionLocal()
+    try:
+        summary, errors = apply_catalog(s, rows, dry_run)
+        if errors:
+            s.rollback()
+            bot.reply_to(message, "❌ هیچ تغییری اعمال نشد:\n" + "\n".join(errors[:20])); return
+        if not dry_run:
+            s.commit()
+            if summary["created"] or summary["updated"]:
+                catalog.bump()
+    except Exception:
+        s.rollback()
+        log.error("Catalog import error: %s", traceback.format_exc())
+        bot.reply_to(message, "⚠️ خطایی رخ داد؛ هیچ تغییری اعمال نشد."); return
+    finally:
+        s.close()
+    bot.reply_to(message, ("🔎 پیش‌نمایش" if dry_run else "✅ کاتالوگ به‌روزرسانی شد") +
+                 f"\nجدید: {summary['created']} | تغییر: {summary['updated']} | بدون تغییر: {summary['unchanged']}")
 
 # ============================
 # Payment proof (single handler)
@@ -810,51 +2919,35 @@ def on_payment_proof(message: Message):
         bot.reply_to(message, "🛠 ربات در حال تعمیرات است.")
         return
 
-    s, order = ensure_order_for_proof(user.id)
+    file_id, ptype = proof_file(message)
     try:
-        if not order:
-            # No awaiting order
-            return
-
-        # Attach proof
-        if message.content_type == "photo":
-            file_id = message.photo[-1].file_id
-            ptype = "photo"
-        else:
-            file_id = message.document.file_id
-            ptype = "document"
-
-        order.payment_proof_file_id = file_id
-        order.payment_proof_type = ptype
-        order.status = "proof_submitted"
-        s.commit()
-
-        caption = (f"🧾 رسید پرداخت جدید\n"
-                   f"کاربر: {user_tag(message.from_user)}\n"
-                   f"کد سفارش: <code>{order.order_code}</code>\n"
-                   f"سفارش: {order.item_title}\n"
-                   f"قیمت: {format_price_toman(order.price_toman)}\n"
-                   f"شناسه چت: <code>{message.chat.id}</code>\n"
-                   f"زمان: {message.date}")
-
-        # Send to admins
-        for admin_id in ADMIN_IDS:
-            try:
-                if ptype == "photo":
-                    bot.send_photo(admin_id, file_id, caption=caption, reply_markup=kb_approve_reject(order.id))
-                else:
-                    bot.send_document(admin_id, file_id, caption=caption, reply_markup=kb_approve_reject(order.id))
-            except Exception:
-                pass
-
-        bot.reply_to(message, "✅ رسید پرداخت دریافت شد. پشتیبانی بررسی خواهد کرد.")
-
+        order = attach_proof(user.id, file_id, ptype)
     except Exception:
-        s.rollback()
         log.error("Proof handler error: %s", traceback.format_exc())
         bot.reply_to(message, "⚠️ خطایی رخ داد. لطفاً دوباره تلاش کنید.")
-    finally:
-        s.close()
+        return
+    if not order:
+        # No awaiting order
+        return
+
+    # Acknowledge first; admin copies go out in the background
+    bot.reply_to(message, "✅ رسید پرداخت دریافت شد. پشتیبانی بررسی خواهد کرد.")
+    admin_notifier.notify_proof(order["id"], ptype, file_id, proof_caption(message, order))
+
+def proof_file(message: Message):
+    """(file_id, "photo" | "document") of a payment proof message."""
+    if message.content_type == "photo":
+        return message.photo[-1].file_id, "photo"
+    return message.document.file_id, "document"
+
+def proof_caption(message: Message, order: dict) -> str:
+    return (f"🧾 رسید پرداخت جدید\n"
+            f"کاربر: {user_tag(message.from_user)}\n"
+            f"کد سفارش: <code>{order['order_code']}</code>\n"
+            f"سفارش: {order['item_title']}\n"
+            f"قیمت: {format_price_toman(order['price_toman'])}\n"
+            f"شناسه چت: <code>{message.chat.id}</code>\n"
+            f"زمان: {message.date}")
 
 # ============================
 # Admin text commands for products / delivery / reject reason / broadcast draft
@@ -875,6 +2968,7 @@ def add_vpn(message: Message):
         try:
             s.add(VpnProduct(title=title, duration_days=int(days), data_gb=int(gb), price_toman=int(price), active=True))
             s.commit()
+            catalog.bump()
             bot.reply_to(message, "✅ VPN اضافه شد.")
         finally:
             s.close()
@@ -893,6 +2987,7 @@ def edit_vpn(message: Message):
             if not p: bot.reply_to(message, "یافت نشد."); return
             p.title = title; p.duration_days = int(days); p.data_gb = int(gb); p.price_toman = int(price); p.active = bool(int(active))
             s.commit()
+            catalog.bump()
             bot.reply_to(message, "✅ VPN ویرایش شد.")
         finally:
             s.close()
@@ -908,7 +3003,7 @@ def del_vpn(message: Message):
         try:
             p = s.get(VpnProduct, int(id_str))
             if not p: bot.reply_to(message, "یافت نشد."); return
-            s.delete(p); s.commit()
+            s.delete(p); s.commit(); catalog.bump()
             bot.reply_to(message, "🗑 حذف شد.")
         finally:
             s.close()
@@ -925,6 +3020,7 @@ def add_app(message: Message):
         try:
             s.add(App(key=key, title=title, active=True))
             s.commit()
+            catalog.bump()
             bot.reply_to(message, "✅ اپ اضافه شد.")
         finally:
             s.close()
@@ -942,7 +3038,7 @@ def edit_app(message: Message):
             a = s.get(App, int(id_str))
             if not a: bot.reply_to(message, "یافت نشد."); return
             a.key = key; a.title = title; a.active = bool(int(active))
-            s.commit(); bot.reply_to(message, "✅ اپ ویرایش شد.")
+            s.commit(); catalog.bump(); bot.reply_to(message, "✅ اپ ویرایش شد.")
         finally:
             s.close()
     except Exception:
@@ -957,7 +3053,7 @@ def del_app(message: Message):
         try:
             a = s.get(App, int(id_str))
             if not a: bot.reply_to(message, "یافت نشد."); return
-            s.delete(a); s.commit()
+            s.delete(a); s.commit(); catalog.bump()
             bot.reply_to(message, "🗑 حذف شد.")
         finally:
             s.close()
@@ -975,7 +3071,7 @@ def add_plan(message: Message):
             a = s.get(App, int(app_id))
             if not a: bot.reply_to(message, "اپ یافت نشد."); return
             s.add(AppPlan(app_id=a.id, title=title, duration_months=int(months), price_toman=int(price), active=True))
-            s.commit(); bot.reply_to(message, "✅ پلن اضافه شد.")
+            s.commit(); catalog.bump(); bot.reply_to(message, "✅ پلن اضافه شد.")
         finally:
             s.close()
     except Exception:
@@ -992,7 +3088,7 @@ def edit_plan(message: Message):
             pl = s.get(AppPlan, int(id_str))
             if not pl: bot.reply_to(message, "پلن یافت نشد."); return
             pl.title = title; pl.duration_months = int(months); pl.price_toman = int(price); pl.active = bool(int(active))
-            s.commit(); bot.reply_to(message, "✅ پلن ویرایش شد.")
+            s.commit(); catalog.bump(); bot.reply_to(message, "✅ پلن ویرایش شد.")
         finally:
             s.close()
     except Exception:
@@ -1007,13 +3103,28 @@ def del_plan(message: Message):
         try:
             pl = s.get(AppPlan, int(id_str))
             if not pl: bot.reply_to(message, "یافت نشد."); return
-            s.delete(pl); s.commit()
+            s.delete(pl); s.commit(); catalog.bump()
             bot.reply_to(message, "🗑 حذف شد.")
         finally:
             s.close()
     except Exception:
         bot.reply_to(message, "❌ فرمت: <code>/del_plan ID</code>")
 
+@bot.message_handler(commands=["export_users", "export_orders"])
+def export_cmd(message: Message):
+    if not is_admin(message.from_user.id): return
+    name = "users" if message.text.split()[0].lstrip("/").split("@")[0] == "export_users" else "orders"
+    try:
+        date_from, date_to, status, gz = parse_export_args(message.text)
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {e}\nفرمت: <code>/export_{name} [از YYYY-MM-DD] [تا YYYY-MM-DD] [status] [gz]</code>")
+        return
+    try:
+        send_export(message.chat.id, name, date_from, date_to, status, gz)
+    except Exception:
+        log.error("Export error: %s", traceback.format_exc())
+        bot.reply_to(message, f"❌ فرمت: <code>/export_{name} [از YYYY-MM-DD] [تا YYYY-MM-DD] [status] [gz]</code>")
+
 # --- Admin free-text states: delivery / reject reason / broadcast draft ---
 @bot.message_handler(content_types=[
     "text","photo","video","animation","document","audio","voice","video_note"
@@ -1026,19 +3137,22 @@ def admin_state_catcher(message: Message):
     if uid not in ADMIN_IDS:
         return
 
-    st = ADMIN_STATE.get(uid)
+    # pop = atomic claim, so a redelivered message (or a second process) can't act on the state twice
+    st = ADMIN_STATE.pop(uid)
     if not st:
         return
-
     mode = st.get("mode")
+    if mode not in ("await_broadcast_draft", "await_delivery", "await_reject_reason"):
+        ADMIN_STATE.set(uid, st)
+        return
 
     # Broadcast draft capture
     if mode == "await_broadcast_draft":
         # Save draft
-        ADMIN_STATE[uid] = {
+        ADMIN_STATE.set(uid, {
             "mode": "broadcast_ready",
             "draft": {"from_chat_id": message.chat.id, "message_id": message.message_id}
-        }
+        })
         bot.reply_to(message, "پیش‌نویس ذخیره شد. سگمنت ارسال را انتخاب کنید:", reply_markup=kb_broadcast_confirm())
         return
 
@@ -1050,7 +3164,6 @@ def admin_state_catcher(message: Message):
             o = s.get(Order, order_id)
             if not o:
                 bot.reply_to(message, "سفارش یافت نشد.")
-                ADMIN_STATE.pop(uid, None)
                 return
 
             # Copy admin message to user
@@ -1059,16 +3172,17 @@ def admin_state_catcher(message: Message):
             except Exception as e:
                 log.warning("Copy to user failed: %s", e)
 
+            record_order_transition(s, o, o.status, "delivered")
             o.status = "delivered"
             o.delivery_note = f"delivered_by_admin:{uid} at {now_utc().isoformat()}"
             s.commit()
             bot.reply_to(message, f"✅ پیام تحویل برای کاربر {o.user_id} ارسال شد.")
         except Exception:
-            s.rollback(); raise
+            s.rollback()
+            ADMIN_STATE.set(uid, st)  # let the admin retry
+            raise
         finally:
             s.close()
-
-        ADMIN_STATE.pop(uid, None)
         return
 
     # Reject reason to send to user
@@ -1079,7 +3193,6 @@ def admin_state_catcher(message: Message):
             o = s.get(Order, order_id)
             if not o:
                 bot.reply_to(message, "سفارش یافت نشد.")
-                ADMIN_STATE.pop(uid, None)
                 return
             o.rejected_reason = message.text if message.content_type == "text" else "(بدون توضیح متنی)"
             s.commit()
@@ -1089,76 +3202,1068 @@ def admin_state_catcher(message: Message):
                 pass
             bot.reply_to(message, "✅ دلیل برای کاربر ارسال شد.")
         except Exception:
-            s.rollback(); raise
+            s.rollback()
+            ADMIN_STATE.set(uid, st)
+            raise
         finally:
             s.close()
-
-        ADMIN_STATE.pop(uid, None)
         return
 
 # ============================
-# Broadcast sender with backoff & block detection
+# Broadcast engine: token bucket + worker pool
 # ============================
-def broadcast_copy(draft, user_ids):
-    from_chat_id = draft["from_chat_id"]
-    message_id = draft["message_id"]
+# Telegram allows ~30 messages/s per bot overall and ~1 message/s per chat.
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "28"))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n: float = 1.0) -> float:
+        """Take n tokens if possible. Returns 0 on success, else seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+    def acquire(self, n: float = 1.0):
+        while True:
+            wait = self.try_acquire(n)
+            if not wait:
+                return
+            time.sleep(wait)
 
-    sent_ok = 0
-    sent_fail = 0
-    batch = 0
+def is_blocked_error(e: Exception) -> bool:
+    text = str(e)
+    return ("Forbidden: bot was blocked by the user" in text or "user is deactivated" in text
+            or getattr(e, "error_code", None) == 403)
 
-    s = SessionLocal()
+def retry_after_of(e: Exception):
+    """Return retry_after seconds for a 429 error, or None if e is not a flood error."""
+    if getattr(e, "error_code", None) != 429 and "Too Many Requests" not in str(e):
+        return None
     try:
-        for uid in user_ids:
-            batch += 1
+        return int((getattr(e, "result_json", None) or {}).get("parameters", {}).get("retry_after", 1))
+    except Exception:
+        return 1
+
+class BroadcastStats:
+    def __init__(self, total: int):
+        self.total = total
+        self.sent_ok = 0
+        self.sent_fail = 0
+        self.blocked = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    @property
+    def done(self) -> int:
+        return self.sent_ok + self.sent_fail
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Sustained messages/sec over the whole run."""
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.done}/{self.total} in {self.elapsed:.1f}s "
+                f"({self.rate:.1f} msg/s, ok={self.sent_ok}, fail={self.sent_fail}, blocked={self.blocked})")
+
+class BroadcastEngine:
+    """
+    Sends one message (copy_message) to many chats from a pool of worker threads.
+    A shared token bucket enforces the global rate; a 429 only delays the chat that
+    got it (the item is re-queued with a not-before time) so other workers keep going.
+    """
+
+    def __init__(self, bot, rate: float = BROADCAST_GLOBAL_RATE, workers: int = BROADCAST_WORKERS,
+                 max_retries: int = BROADCAST_MAX_RETRIES, per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.per_chat_interval = per_chat_interval
+
+    def run(self, from_chat_id: int, message_id: int, user_ids, on_result=None, progress_every: float = 5.0,
+            more=None):
+        """
+        Blocks until every recipient is handled. on_result(uid, status) is called from the
+        worker threads with status in {"sent", "failed", "blocked"}.
+        more(), if given, returns the next batch of user ids ([] when there are no more). It is
+        called whenever the queue runs low, so workers keep sending while 429-delayed
+        retries wait instead of idling until a batch is fully settled. If more() raises,
+        feeding stops, the recipients already queued are still handled and run() then
+        re-raises the error (it is never mistaken for the end of the audience).
+        """
+        user_ids = list(user_ids)
+        stats = BroadcastStats(len(user_ids))
+        pending = collections.deque((uid, 0) for uid in user_ids)
+        delayed = []  # heap of (not_before, uid, attempt)
+        cond = threading.Condition()
+        in_flight = [0]
+        feed = {"done": more is None, "busy": False, "error": None}
+
+        def refill():
             try:
-                bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
-                sent_ok += 1
-            except ApiException as e:
-                sent_fail += 1
-                # if blocked, mark
-                if "Forbidden: bot was blocked by the user" in str(e) or "user is deactivated" in str(e):
-                    u = s.get(User, uid)
-                    if u:
-                        u.blocked = True
-                        u.allow_broadcast = False
-                        s.add(u)
-                        s.commit()
-                # handle flood control
-                elif "Too Many Requests" in str(e):
-                    # naive backoff read retry-after if exists in e.result_json
-                    retry_after = 1
-                    try:
-                        retry_after = int(getattr(e, "result_json", {}).get("parameters", {}).get("retry_after", 1))
-                    except Exception:
-                        pass
-                    time.sleep(retry_after + 1)
+                batch = list(more())
+            except Exception as e:
+                log.error("Broadcast feed error: %s", traceback.format_exc())
+                with cond:
+                    feed.update(done=True, busy=False, error=e)
+                    cond.notify_all()
+                return
+            with cond:
+                pending.extend((uid, 0) for uid in batch)
+                with stats.lock:
+                    stats.total += len(batch)
+                feed["done"] = not batch
+                feed["busy"] = False
+                cond.notify_all()
+
+        def next_item():
+            while True:
+                with cond:
+                    now = time.monotonic()
+                    if not feed["done"] and not feed["busy"] and len(pending) <= self.workers:
+                        feed["busy"] = True
+                    elif delayed and delayed[0][0] <= now:
+                        _, uid, attempt = heapq.heappop(delayed)
+                        in_flight[0] += 1
+                        return uid, attempt
+                    elif pending:
+                        in_flight[0] += 1
+                        return pending.popleft()
+                    elif not delayed and not in_flight[0] and feed["done"]:
+                        cond.notify_all()
+                        return None
+                    else:
+                        cond.wait(timeout=(delayed[0][0] - now) if delayed else None)
+                        continue
+                refill()
+
+        def finish(uid, status):
+            metrics.inc("broadcast_messages_total", status=status)
+            with stats.lock:
+                if status == "sent":
+                    stats.sent_ok += 1
                 else:
-                    # generic small sleep to be gentle
-                    time.sleep(0.05)
+                    stats.sent_fail += 1
+                    if status == "blocked":
+                        stats.blocked += 1
+            if on_result:
+                try:
+                    on_result(uid, status)
+                except Exception:
+                    log.error("Broadcast on_result error: %s", traceback.format_exc())
+
+        def worker():
+            while True:
+                item = next_item()
+                if item is None:
+                    return
+                uid, attempt = item
+                self.bucket.acquire()
+                status, retry_in = "failed", None
+                try:
+                    self.bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
+                    status = "sent"
+                except ApiException as e:
+                    retry_after = retry_after_of(e)
+                    if is_blocked_error(e):
+                        status = "blocked"
+                    elif retry_after is not None and attempt < self.max_retries:
+                        retry_in = max(retry_after, self.per_chat_interval)
+                except Exception:
+                    if attempt < self.max_retries:
+                        retry_in = self.per_chat_interval * (attempt + 1)
+                with cond:
+                    in_flight[0] -= 1
+                    if retry_in is not None:
+                        metrics.inc("broadcast_retries_total")
+                        heapq.heappush(delayed, (time.monotonic() + retry_in, uid, attempt + 1))
+                    cond.notify_all()
+                if retry_in is None:
+                    finish(uid, status)
+
+        threads = [threading.Thread(target=worker, name=f"bcast-{i}", daemon=True)
+                   for i in range(self.workers if more is not None else (min(self.workers, len(user_ids)) or 1))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=progress_every)
+                if t.is_alive():
+                    log.info("Broadcast progress: %s", stats.summary())
+        stats.finished = time.monotonic()
+        metrics.set("broadcast_last_rate", stats.rate)
+        log.info("Broadcast finished: %s", stats.summary())
+        if feed["error"] is not None:
+            raise feed["error"]
+        return stats
+
+BLOCKED_FLUSH_MS = int(os.getenv("BLOCKED_FLUSH_MS", "2000"))
+BLOCKED_FLUSH_MAX = int(os.getenv("BLOCKED_FLUSH_MAX", "500"))
+
+class BlockedUsers:
+    """
+    Blocked-user pipeline. Send loops only call add(uid); ids are buffered and written
+    with one bulk UPDATE (queued on the db writer, never waited on) every BLOCKED_FLUSH_MS
+    or BLOCKED_FLUSH_MAX ids. The set of known blocked ids is kept in memory so
+    seen(uid), called for every incoming message, can clear the flag when a user who
+    blocked the bot comes back (typically with /start) without a query per message.
+    """
+
+    def __init__(self, flush_ms: int = BLOCKED_FLUSH_MS, max_pending: int = BLOCKED_FLUSH_MAX):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_pending = max_pending
+        self.pending = set()
+        self.known = None  # lazily loaded set of blocked user ids
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _load(self):
+        if self.known is not None:
+            return
+        s = SessionLocal()
+        try:
+            ids = {uid for (uid,) in s.execute(select(User.id).where(User.blocked == True))}
+        finally:
+            s.close()
+        with self.lock:
+            if self.known is None:
+                self.known = ids
+
+    def add(self, uid: int):
+        with self.lock:
+            self.pending.add(uid)
+            if self.known is not None:
+                self.known.add(uid)
+            full = len(self.pending) >= self.max_pending
+        self._ensure_thread()
+        if full:
+            self.flush()
+
+    def seen(self, uid: int):
+        """The user talked to the bot, so they are not blocking it (any more)."""
+        self._load()
+        with self.lock:
+            if uid not in self.known:
+                return
+            self.known.discard(uid)
+            self.pending.discard(uid)
+
+        # only the blocked flag is cleared; allow_broadcast keeps whatever the user chose
+        def write(s):
+            s.execute(update(User).where(User.id == uid, User.blocked == True).values(blocked=False))
+            return s.scalar(select(User.allow_broadcast).where(User.id == uid))
+
+        def done(fut):
+            if fut.exception():
+                log.error("Unblock update failed: %r", fut.exception())
+            else:
+                audience.set_eligible([uid], fut.result() is not False)
+
+        db_writer.submit(write).add_done_callback(done)
+
+    def flush(self, wait: bool = False):
+        with self.lock:
+            if not self.pending:
+                return 0
+            ids, self.pending = sorted(self.pending), set()
+        fut = self._write(update(User).where(User.id.in_(ids)).values(blocked=True))
+        audience.set_eligible(ids, False)
+        metrics.inc("users_blocked_total", len(ids))
+        if wait:
+            fut.result(timeout=30)
+        return len(ids)
+
+    @staticmethod
+    def _write(stmt):
+        fut = db_writer.submit(lambda s: s.execute(stmt))
+        fut.add_done_callback(lambda f: f.exception() and log.error("Blocked-user update failed: %r", f.exception()))
+        return fut
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._loop, name="blocked-flush", daemon=True)
+                    self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
             except Exception:
-                sent_fail += 1
+                log.error("Blocked-user flush error: %s", traceback.format_exc())
+
+blocked_users = BlockedUsers()
+atexit.register(lambda: blocked_users.flush(wait=True))
+
+def broadcast_copy(draft, user_ids):
+    def on_result(uid, status):
+        if status == "blocked":
+            blocked_users.add(uid)
+
+    stats = BroadcastEngine(bot).run(draft["from_chat_id"], draft["message_id"], user_ids, on_result=on_result)
+    blocked_users.flush()
+    return stats
 
-            # pace messages
-            time.sleep(0.03)
+# ============================
+# Durable broadcast jobs (BroadcastLog + BroadcastRecipient)
+# ============================
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_CHECKPOINT_EVERY = 100  # results buffered before a checkpoint commit
 
-            # soft break per 50 messages
-            if batch % 50 == 0:
-                time.sleep(0.5)
+def enqueue_broadcast(admin_id: int, draft, segment: str, user_ids, report_chat_id=None, report_message_id=None) -> int:
+    """Persist a broadcast job with one pending row per recipient and wake the worker."""
+    s = SessionLocal()
+    try:
+        job = BroadcastLog(admin_id=admin_id, from_chat_id=draft["from_chat_id"], message_id=draft["message_id"],
+                           segment=segment, status="queued", total=0, sent_ok=0, sent_fail=0, sent_blocked=0,
+                           report_chat_id=report_chat_id, report_message_id=report_message_id)
+        s.add(job)
+        s.flush()
+        total = 0
+        for chunk in chunked(user_ids, 1000):
+            s.execute(insert(BroadcastRecipient), [{"broadcast_id": job.id, "user_id": u, "state": "pending"} for u in chunk])
+            total += len(chunk)
+        job.total = total
+        s.commit()
+        job_id = job.id
+    except Exception:
+        s.rollback()
+        raise
     finally:
         s.close()
+    broadcast_worker.wake()
+    return job_id
+
+def chunked(iterable, size: int):
+    buf = []
+    for x in iterable:
+        buf.append(x)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+BROADCAST_LEASE_SEC = int(os.getenv("BROADCAST_LEASE_SEC", "60"))
+
+class BroadcastJobWorker:
+    """
+    Single background thread that drains queued/running broadcast jobs chunk by chunk.
+    A job is leased to one process at a time (owner + lease_until, renewed while it
+    runs), recipients are claimed with a guarded pending -> sending UPDATE and settled in
+    small checkpoint commits, so several bot processes and restarts never re-send.
+    """
+
+    def __init__(self, engine_factory=None, chunk_size: int = BROADCAST_CHUNK,
+                 owner: str = WORKER_ID, lease_sec: int = BROADCAST_LEASE_SEC):
+        self.engine_factory = engine_factory or (lambda: BroadcastEngine(bot))
+        self.chunk_size = chunk_size
+        self.owner = owner
+        self.lease = timedelta(seconds=lease_sec)
+        self.event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.recover()
+            self.thread = threading.Thread(target=self._loop, name="broadcast-jobs", daemon=True)
+            self.thread.start()
+
+    def wake(self):
+        self.start()
+        self.event.set()
+
+    def _lease_free(self, now):
+        """Jobs nobody holds: never leased, leased by us, or whose owner stopped renewing."""
+        return ((BroadcastLog.owner == None) | (BroadcastLog.owner == self.owner)
+                | (BroadcastLog.lease_until == None) | (BroadcastLog.lease_until < now))
+
+    def recover(self):
+        """Settle recipients claimed by processes whose lease expired: we can't know if they got it."""
+        s = SessionLocal()
+        try:
+            stale = select(BroadcastLog.id).where(BroadcastLog.status == "running",
+                                                  (BroadcastLog.owner == None) | (BroadcastLog.owner != self.owner),
+                                                  self._lease_free(now_utc()))
+            n = s.execute(update(BroadcastRecipient)
+                          .where(BroadcastRecipient.state == "sending", BroadcastRecipient.broadcast_id.in_(stale))
+                          .values(state="failed", updated_at=now_utc())).rowcount
+            s.commit()
+            if n:
+                log.warning("Broadcast recovery: %d in-flight recipients marked failed", n)
+        except Exception:
+            s.rollback()
+            log.error("Broadcast recovery error: %s", traceback.format_exc())
+        finally:
+            s.close()
+
+    def _loop(self):
+        while True:
+            try:
+                job_id = self._next_job()
+                if job_id is None:
+                    self.event.wait(timeout=30)
+                    self.event.clear()
+                    continue
+                self.process(job_id)
+            except Exception:
+                log.error("Broadcast worker error: %s", traceback.format_exc())
+                time.sleep(5)
+
+    def _next_job(self):
+        """Lease the oldest unfinished job no live process holds; None if there is none."""
+        s = SessionLocal()
+        try:
+            now = now_utc()
+            for job_id in s.execute(select(BroadcastLog.id)
+                                    .where(BroadcastLog.status.in_(["queued", "running"]), self._lease_free(now))
+                                    .order_by(BroadcastLog.id).limit(5)).scalars().all():
+                taken = s.execute(update(BroadcastLog)
+                                  .where(BroadcastLog.id == job_id, BroadcastLog.status.in_(["queued", "running"]),
+                                         self._lease_free(now))
+                                  .values(owner=self.owner, lease_until=now + self.lease, status="running")
+                                  ).rowcount == 1
+                if taken:
+                    # rows the previous holder left in "sending" may or may not have been delivered
+                    n = s.execute(update(BroadcastRecipient)
+                                  .where(BroadcastRecipient.broadcast_id == job_id, BroadcastRecipient.state == "sending")
+                                  .values(state="failed", updated_at=now)).rowcount
+                    s.commit()
+                    if n:
+                        log.warning("Broadcast job #%s: %d in-flight recipients of the previous owner marked failed", job_id, n)
+                    return job_id
+                s.commit()
+            return None
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+
+    def _renew(self, job_id: int) -> bool:
+        """Extend our lease; False if another process took the job over."""
+        s = SessionLocal()
+        try:
+            held = s.execute(update(BroadcastLog)
+                             .where(BroadcastLog.id == job_id, BroadcastLog.owner == self.owner)
+                             .values(lease_until=now_utc() + self.lease)).rowcount == 1
+            s.commit()
+            return held
+        except Exception:
+            s.rollback()
+            log.error("Broadcast lease renewal error: %s", traceback.format_exc())
+            return True  # transient; the lease still has time left
+        finally:
+            s.close()
+
+    def _claim_chunk(self, job_id: int):
+        """Move up to chunk_size pending recipients to sending; returns {user_id: row id} of rows WE moved."""
+        s = SessionLocal()
+        try:
+            ids = s.execute(select(BroadcastRecipient.id)
+                            .where(BroadcastRecipient.broadcast_id == job_id, BroadcastRecipient.state == "pending")
+                            .order_by(BroadcastRecipient.id).limit(self.chunk_size)).scalars().all()
+            if not ids:
+                return {}
+            stmt = (update(BroadcastRecipient)
+                    .where(BroadcastRecipient.id.in_(ids), BroadcastRecipient.state == "pending")
+                    .values(state="sending", updated_at=now_utc()))
+            if engine.dialect.update_returning:
+                rows = s.execute(stmt.returning(BroadcastRecipient.id, BroadcastRecipient.user_id)).all()
+            else:
+                # FOR UPDATE SKIP LOCKED keeps other claimers off these rows; the guarded UPDATE
+                # covers databases that ignore it, falling back to row-by-row claims on a race
+                rows = s.execute(select(BroadcastRecipient.id, BroadcastRecipient.user_id)
+                                 .where(BroadcastRecipient.id.in_(ids), BroadcastRecipient.state == "pending")
+                                 .with_for_update(skip_locked=True)).all()
+                if rows and s.execute(stmt.where(BroadcastRecipient.id.in_([r.id for r in rows]))).rowcount != len(rows):
+                    s.rollback()
+                    rows = [r for r in rows
+                            if s.execute(update(BroadcastRecipient)
+                                         .where(BroadcastRecipient.id == r.id, BroadcastRecipient.state == "pending")
+                                         .values(state="sending", updated_at=now_utc())).rowcount == 1]
+            s.commit()
+            return {r.user_id: r.id for r in rows}
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+
+    def _checkpoint(self, job_id: int, results):
+        """Write a batch of (recipient_row_id, state) results and bump the job counters."""
+        if not results:
+            return
+        by_state = collections.defaultdict(list)
+        for row_id, state in results:
+            by_state[state].append(row_id)
+        ok = len(by_state.get("sent", []))
+
+        def write(s):
+            for state, ids in by_state.items():
+                s.execute(update(BroadcastRecipient).where(BroadcastRecipient.id.in_(ids))
+                          .values(state=state, updated_at=now_utc()))
+            s.execute(update(BroadcastLog).where(BroadcastLog.id == job_id).values(
+                sent_ok=BroadcastLog.sent_ok + ok,
+                sent_fail=BroadcastLog.sent_fail + (len(results) - ok),
+                sent_blocked=BroadcastLog.sent_blocked + len(by_state.get("blocked", [])),
+            ))
+
+        db_writer.run(write)
+
+    def process(self, job_id: int):
+        """Send the job through one engine run, claiming chunk after chunk as its queue drains."""
+        s = SessionLocal()
+        try:
+            job = s.get(BroadcastLog, job_id)
+            from_chat_id, message_id = job.from_chat_id, job.message_id
+        finally:
+            s.close()
+        started = time.monotonic()
+        row_ids = {}  # user_id -> recipient row id, across chunks
+        buf = []
+        buf_lock = threading.Lock()
+        held = threading.Event()
+        held.set()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease.total_seconds() / 3):
+                if not self._renew(job_id):
+                    log.warning("Broadcast job #%s: lease lost, not claiming further chunks", job_id)
+                    held.clear()
+                    return
+
+        def more():
+            if not held.is_set():
+                return []
+            claimed = self._claim_chunk(job_id)
+            with buf_lock:
+                row_ids.update(claimed)
+            return list(claimed)
+
+        def on_result(uid, status):
+            if status == "blocked":
+                blocked_users.add(uid)
+            with buf_lock:
+                buf.append((row_ids[uid], status))
+                if len(buf) < BROADCAST_CHECKPOINT_EVERY:
+                    return
+                batch = buf[:]
+                buf.clear()
+            self._checkpoint(job_id, batch)
+
+        threading.Thread(target=heartbeat, name=f"bcast-lease-{job_id}", daemon=True).start()
+        try:
+            stats = self.engine_factory().run(from_chat_id, message_id, [], on_result=on_result, more=more)
+        finally:
+            # a failed claim propagates to _loop, which retries; the job stays leased to us
+            stop.set()
+            self._checkpoint(job_id, buf)
+        if held.is_set():
+            self._finish(job_id, stats.done / (time.monotonic() - started) if stats.done else 0.0)
+
+    def _finish(self, job_id: int, rate: float):
+        """Mark the job done, unless recipients are still unsettled: then release it to be resumed."""
+        s = SessionLocal()
+        try:
+            job = s.get(BroadcastLog, job_id)
+            left = s.scalar(select(func.count()).select_from(BroadcastRecipient)
+                            .where(BroadcastRecipient.broadcast_id == job_id,
+                                   BroadcastRecipient.state.in_(["pending", "sending"])))
+            if left:
+                job.owner = job.lease_until = None
+                s.commit()
+                log.warning("Broadcast job #%s: %d recipients not settled, left for resume", job_id, left)
+                return
+            job.status = "done"
+            job.finished_at = now_utc()
+            job.owner = job.lease_until = None
+            s.commit()
+            report = (job.report_chat_id, job.report_message_id, job.sent_ok, job.sent_fail, job.sent_blocked)
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+        chat_id, status_message_id, ok, fail, blocked = report
+        log.info("Broadcast job #%s done: ok=%s fail=%s blocked=%s (%.1f msg/s)", job_id, ok, fail, blocked, rate)
+        if chat_id and status_message_id:
+            try:
+                bot.edit_message_text(
+                    f"✅ ارسال همگانی #{job_id} پایان یافت.\nموفق: {ok}\nناموفق: {fail} (مسدود: {blocked})\n"
+                    f"⚡ {rate:.1f} پیام/ثانیه",
+                    chat_id=chat_id, message_id=status_message_id)
+            except Exception:
+                log.warning("Broadcast report failed: %s", traceback.format_exc())
+
+broadcast_worker = BroadcastJobWorker()
 
-    return sent_ok, sent_fail
+# ============================
+# Webhook server
+# ============================
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")      # public https base, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")  # TLS is expected to end at a reverse proxy
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(max(4, (os.cpu_count() or 1) * 2))))
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))
+WEBHOOK_MAX_BODY = 1 << 20
+
+def update_shard_key(update: dict) -> int:
+    """Chat/user id of a raw update, so one user's updates always go to the same worker (in order)."""
+    for kind in ("message", "edited_message", "callback_query", "channel_post", "my_chat_member"):
+        obj = update.get(kind)
+        if obj:
+            chat = obj.get("chat") or (obj.get("message") or {}).get("chat") or obj.get("from") or {}
+            return int(chat.get("id") or 0)
+    return int(update.get("update_id") or 0)
+
+class WebhookServer:
+    """
+    Minimal HTTP endpoint for Telegram updates.
+    POST <WEBHOOK_PATH> with the X-Telegram-Bot-Api-Secret-Token header is parsed and handed
+    to one of WEBHOOK_WORKERS bounded queues (sharded by chat). A full queue answers 503 so
+    Telegram backs off and redelivers instead of the process buffering without limit.
+    GET /healthz reports queue depths, GET /metrics serves Prometheus metrics. Locally: curl -XPOST -H 'X-Telegram-Bot-Api-Secret-Token: …'
+    --data @update.json http://127.0.0.1:8080/telegram
+    """
+
+    def __init__(self, bot, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret: str = WEBHOOK_SECRET, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        per_worker = max(1, queue_size // max(1, workers))
+        self.queues = [queue.Queue(maxsize=per_worker) for _ in range(max(1, workers))]
+        self.rejected = 0
+        self.httpd = http.server.ThreadingHTTPServer((listen, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                log.debug("webhook: " + fmt, *args)
+
+            def _reply(self, code: int, body: bytes = b""):
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    return self._reply(200, metrics.render().encode())
+                if self.path != "/healthz":
+                    return self._reply(404)
+                depth = ",".join(str(q.qsize()) for q in server.queues)
+                self._reply(200, f"ok queues={depth} rejected={server.rejected}\n".encode())
+
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._reply(404)
+                if server.secret and not hmac.compare_digest(
+                        self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), server.secret):
+                    return self._reply(403)
+                length = int(self.headers.get("Content-Length") or 0)
+                if not 0 < length <= WEBHOOK_MAX_BODY:
+                    return self._reply(400)
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self._reply(400)
+                if not server.submit(update):
+                    return self._reply(503)
+                self._reply(200)
+
+        return Handler
+
+    def submit(self, update: dict) -> bool:
+        q = self.queues[update_shard_key(update) % len(self.queues)]
+        try:
+            q.put_nowait(update)
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def _work(self, q):
+        while True:
+            raw = q.get()
+            try:
+                self.bot.process_new_updates([types.Update.de_json(raw)])
+            except Exception:
+                log.error("Webhook update error: %s", traceback.format_exc())
+
+    def serve_forever(self):
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._work, args=(q,), name=f"webhook-{i}", daemon=True).start()
+        log.info("Webhook server on %s:%s%s (%d workers)", *self.httpd.server_address[:2], self.path, len(self.queues))
+        self.httpd.serve_forever()
+
+def run_webhook(target=bot):
+    """target is anything with process_new_updates(updates): the sync bot or an AsyncRuntime."""
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # admin rights come from update.from.id, so an unauthenticated endpoint accepts forged admin updates
+        raise RuntimeError("WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+    server = WebhookServer(target)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        allowed_updates=telebot.util.update_types, drop_pending_updates=True)
+    else:
+        log.warning("WEBHOOK_URL is empty; not registering with Telegram (local testing mode)")
+    server.serve_forever()
+
+# ============================
+# Async runtime (RUNTIME=async)
+# ============================
+# AsyncTeleBot + SQLAlchemy's async engine on one event loop. The customer hot paths
+# (start, menus, ordering, payment proof, settings) are native coroutines; admin commands,
+# conversations and catalog/export tools keep their sync handlers and run in
+# asyncio.to_thread. Writes still go through db_writer, awaited via its Future, so SQLite
+# keeps a single writer in both runtimes. Broadcasts stay on BroadcastJobWorker's thread.
+ASYNC_HTTP_LIMIT = int(os.getenv("ASYNC_HTTP_LIMIT", "100"))         # keep-alive connections to the Bot API
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "1000"))    # webhook updates being handled at once
+
+def async_database_url(url: str) -> str:
+    """sqlite:///x.db -> sqlite+aiosqlite:///x.db, postgresql://… -> postgresql+asyncpg://…"""
+    scheme, sep, rest = url.partition("://")
+    driver = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg",
+              "postgres": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}.get(scheme, scheme)
+    return driver + sep + rest
+
+ASYNC_ROUTES = {}  # router key -> coroutine fn(ctx); other keys fall back to the sync router
+
+def async_route(key: str):
+    def deco(fn):
+        ASYNC_ROUTES[key] = fn
+        return fn
+    return deco
+
+class AsyncCallbackContext:
+    """CallbackContext for coroutine routes: no implicit session, awaitable answer/edit."""
+
+    def __init__(self, runtime, call: CallbackQuery, route: str, args):
+        self.rt = runtime
+        self.call = call
+        self.uid = call.from_user.id
+        self.route = route
+        self.args = args
+        self.answered = False
+
+    @property
+    def chat_id(self) -> int:
+        return self.call.message.chat.id
+
+    @property
+    def message_id(self) -> int:
+        return self.call.message.message_id
+
+    def int_arg(self, i: int = 0) -> int:
+        return int(self.args[i])
+
+    async def answer(self, text: str = None, alert: bool = False):
+        if self.answered:
+            return
+        self.answered = True
+        await self.rt.bot.answer_callback_query(self.call.id, text, show_alert=alert)
+
+    async def alert(self, text: str):
+        await self.answer(text, alert=True)
+
+    async def edit(self, text: str, reply_markup=None):
+        await self.rt.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id,
+                                            reply_markup=reply_markup)
+
+class AsyncRuntime:
+    def __init__(self):
+        from telebot.async_telebot import AsyncTeleBot
+        from telebot import asyncio_helper
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        asyncio_helper.REQUEST_LIMIT = ASYNC_HTTP_LIMIT  # one aiohttp session, connections reused
+        self.bot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+        self.bot.register_message_handler(self.on_message, func=lambda m: True,
+                                          content_types=telebot.util.content_type_media)
+        self.bot.register_callback_query_handler(self.on_callback, func=lambda c: True)
+
+        kwargs = {"echo": False, "pool_pre_ping": True}
+        if IS_SQLITE:
+            kwargs["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+        if not SQLITE_IN_MEMORY:
+            kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+        self.engine = create_async_engine(async_database_url(DATABASE_URL), **kwargs)
+        if IS_SQLITE and SQLITE_PROFILE == "production":
+            event.listen(self.engine.sync_engine, "connect", sqlite_pragmas)
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+        metrics.watch_engine(self.engine.sync_engine)
+        transport.install_async()
+        metrics.watch_telegram_async()
+        self.loop = None
+        self.inflight = threading.BoundedSemaphore(ASYNC_MAX_INFLIGHT)
+
+    # --- db / activity ---
+    async def write(self, job):
+        """Run a db_writer job without blocking the loop."""
+        if db_writer.enabled:
+            return await asyncio.wrap_future(db_writer.submit(job))
+        async with self.Session() as s:
+            result = await s.run_sync(job)
+            await s.commit()
+            return result
+
+    async def refresh_caches(self):
+        """Reload stale settings / catalog on a worker thread so handlers read them from memory."""
+        if not catalog.is_fresh():
+            await asyncio.to_thread(catalog.snapshot)
+
+    async def touch(self, message: Message):
+        user = message.from_user
+        if activity_buffer.touch(user, flush=False):
+            await asyncio.to_thread(activity_buffer.flush)
+        if blocked_users.known is None:
+            await asyncio.to_thread(blocked_users._load)
+        blocked_users.seen(user.id)
+        return user
+
+    # --- dispatch ---
+    async def on_callback(self, call: CallbackQuery):
+        reason = update_guard.check_callback(call)
+        if reason:
+            if reason != "duplicate":
+                await self.bot.answer_callback_query(call.id, GUARD_SLOW_DOWN if reason == "rate" else None)
+            return
+        key, args = router.resolve(call.data or "")
+        fn = ASYNC_ROUTES.get(key)
+        if fn is None:
+            await asyncio.to_thread(bot.process_new_callback_query, [call])
+            return
+        ctx = AsyncCallbackContext(self, call, key, args)
+        started = time.perf_counter()
+        try:
+            await self.refresh_caches()
+            if not key.startswith("nav") and not is_admin(ctx.uid) and maintenance_enabled():
+                await ctx.alert("ربات در حال تعمیرات است.")
+                return
+            await fn(ctx)
+            await ctx.answer()
+        except Exception:
+            log.error("Callback error (%s): %s", key, traceback.format_exc())
+            try:
+                ctx.answered = False
+                await ctx.alert("خطا رخ داد.")
+            except Exception:
+                pass
+        finally:
+            router.record(key, time.perf_counter() - started)
+
+    async def on_message(self, message: Message):
+        if update_guard.check_message(message):
+            return
+        started = time.perf_counter()
+        if not is_admin(message.from_user.id):
+            if message.content_type == "text" and (message.text or "").split("@")[0].split()[:1] == ["/start"]:
+                handler = self.on_start
+            elif message.content_type in ("photo", "document"):
+                handler = self.on_payment_proof
+            else:
+                handler = None
+            if handler is not None:
+                try:
+                    await handler(message)
+                except Exception:
+                    log.error("Async handler error: %s", traceback.format_exc())
+                finally:
+                    metrics.observe("handler", handler.__name__, time.perf_counter() - started)
+                return
+        await asyncio.to_thread(bot.process_new_messages, [message])
+
+    # --- message handlers ---
+    async def on_start(self, message: Message):
+        await self.touch(message)
+        await self.refresh_caches()
+        if maintenance_enabled():
+            await self.bot.send_message(message.chat.id, "🛠 ربات در حال تعمیرات است. لطفاً بعداً امتحان کنید.\nاگر ضروری است از پشتیبانی کمک بگیرید.", reply_markup=kb_contact())
+            return
+        await self.bot.send_message(message.chat.id, "سلام 👋\nاز منو یکی را انتخاب کنید:", reply_markup=kb_main())
+
+    async def on_payment_proof(self, message: Message):
+        user = await self.touch(message)
+        await self.refresh_caches()
+        if maintenance_enabled():
+            await self.bot.reply_to(message, "🛠 ربات در حال تعمیرات است.")
+            return
+        file_id, ptype = proof_file(message)
+        try:
+            order = await self.write(attach_proof_job(user.id, file_id, ptype))
+        except Exception:
+            log.error("Proof handler error: %s", traceback.format_exc())
+            await self.bot.reply_to(message, "⚠️ خطایی رخ داد. لطفاً دوباره تلاش کنید.")
+            return
+        if not order:
+            return
+        await self.bot.reply_to(message, "✅ رسید پرداخت دریافت شد. پشتیبانی بررسی خواهد کرد.")
+        admin_notifier.notify_proof(order["id"], ptype, file_id, proof_caption(message, order))
+
+    # --- webhook bridge ---
+    def process_new_updates(self, updates):
+        """Called from WebhookServer worker threads; hands the updates to the loop and returns."""
+        self.inflight.acquire()
+        fut = asyncio.run_coroutine_threadsafe(self.bot.process_new_updates(updates), self.loop)
+        fut.add_done_callback(lambda f: self.inflight.release())
+
+    async def main(self):
+        from telebot import asyncio_helper
+        self.loop = asyncio.get_running_loop()
+        # everything the hot paths read from memory is loaded before the first update
+        await asyncio.to_thread(settings_cache.snapshot)
+        await asyncio.to_thread(catalog.snapshot)
+        await asyncio.to_thread(blocked_users._load)
+        try:
+            if RUN_MODE == "webhook":
+                await asyncio.to_thread(run_webhook, self)
+            else:
+                await self.bot.infinity_polling(timeout=30, skip_pending=True,
+                                                allowed_updates=telebot.util.update_types)
+        finally:
+            if asyncio_helper.session_manager.session is not None:
+                await asyncio_helper.session_manager.session.close()
+            await self.engine.dispose()
+
+# Customer routes. Same texts and keyboards as the sync handlers above.
+@async_route("nav:home")
+async def acb_home(ctx):
+    await ctx.edit("از منو یکی را انتخاب کنید:", kb_main())
+
+@async_route("nav:vpn")
+async def acb_vpn_menu(ctx):
+    await ctx.edit("🛡️ خرید VPN — پلن مورد نظر را انتخاب کنید:", kb_vpn_menu())
+
+@async_route("nav:apps")
+async def acb_apps_menu(ctx):
+    await ctx.edit("🛍️ اشتراک اپ‌ها — یک اپ را انتخاب کنید:", kb_apps_menu())
+
+@async_route("app")
+async def acb_app(ctx):
+    app_id = ctx.int_arg()
+    a = catalog.snapshot().apps.get(app_id)
+    if not a:
+        await ctx.alert("این اپ فعال نیست."); return
+    await ctx.edit(f"{a['title']}\nیک پلن را انتخاب کنید:", kb_app_plans(app_id))
+
+@async_route("vpn")
+@async_route("plan")
+async def acb_order(ctx):
+    spec = (vpn_order_spec if ctx.route == "vpn" else plan_order_spec)(ctx.int_arg())
+    if not spec:
+        await ctx.alert("این محصول موجود نیست." if ctx.route == "vpn" else "این پلن فعال نیست."); return
+    code, job = place_order_job(ctx.uid, **spec)
+    await ctx.rt.write(job)
+    await ctx.edit(order_placed_text(spec, code), kb_payment())
+
+@async_route("pay:card")
+async def acb_pay_card(ctx):
+    await ctx.rt.bot.send_message(ctx.chat_id, PAY_CARD_TEXT)
+
+@async_route("nav:support")
+async def acb_support(ctx):
+    await ctx.edit("📞 تماس با پشتیبانی\nبرای گفتگو مستقیم با پشتیبان، روی دکمه زیر بزنید:", kb_contact())
+
+@async_route("nav:settings")
+async def acb_settings(ctx):
+    async with ctx.rt.Session() as s:
+        allow = await s.scalar(select(User.allow_broadcast).where(User.id == ctx.uid))
+    await ctx.edit("⚙️ تنظیمات حساب:", kb_user_settings(allow is not False))
+
+@async_route("usr:toggle_bcast")
+async def acb_toggle_bcast(ctx):
+    stmt = toggle_broadcast_stmt(ctx.uid)
+    async with ctx.rt.Session() as s:
+        if ctx.rt.engine.dialect.update_returning:
+            row = (await s.execute(stmt.returning(User.allow_broadcast, User.blocked))).first()
+        else:
+            await s.execute(stmt)
+            row = (await s.execute(select(User.allow_broadcast, User.blocked).where(User.id == ctx.uid))).first()
+        await s.commit()
+    if row is None:
+        await ctx.alert("ابتدا /start را بزنید."); return
+    allow, blocked = row
+    audience.set_eligible([ctx.uid], allow and not blocked)
+    await ctx.rt.bot.edit_message_reply_markup(ctx.chat_id, ctx.message_id, reply_markup=kb_user_settings(allow))
+    await ctx.answer("تنظیم شد.")
+
+def run_async():
+    asyncio.run(AsyncRuntime().main())
+
+# ============================
+# Instrumentation (after every handler is registered)
+# ============================
+def instrument_handlers(bot):
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for h in handlers:
+            h["function"] = metrics.update_handler(h["function"])
+
+instrument_handlers(bot)
+metrics.collectors.append(lambda: [
+    ("db_writer_commits", {}, db_writer.commits),
+    ("db_writer_jobs", {}, db_writer.jobs_done),
+    ("db_writer_queue", {}, db_writer.jobs.qsize()),
+])
 
 # ============================
 # Run
 # ============================
 if __name__ == "__main__":
     log.info("Bot is running…")
-    # توصیه تولیدی: از وبهوک استفاده کنید. اینجا برای سادگی polling:
-    while True:
-        try:
-            bot.infinity_polling(timeout=30, long_polling_timeout=30, allowed_updates=telebot.util.update_types)
-        except Exception as e:
-            log.error("Polling crashed: %s", traceback.format_exc())
-            time.sleep(3)
+    keyboards.warm()          # static reply markups, serialized once
+    order_codes.seed()        # continue after today's codes from a previous run
+    broadcast_worker.start()  # resumes unfinished broadcast jobs
+    if METRICS_PORT:
+        start_metrics_server()
+    if RUNTIME == "async":
+        run_async()           # polling or webhook, per RUN_MODE
+    elif RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        # توصیه تولیدی: از وبهوک استفاده کنید (RUN_MODE=webhook). در غیر این صورت polling:
+        while True:
+            try:
+                bot.infinity_polling(timeout=30, long_polling_timeout=30, allowed_updates=telebot.util.update_types)
+            except Exception as e:
+                log.error("Polling crashed: %s", traceback.format_exc())
+                time.sleep(3)
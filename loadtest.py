@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+"""
+Offline load test for Promain.py.
+
+Starts a local fake Telegram Bot API (records calls, injects 429/403, adds latency),
+points telebot at it and replays synthetic update streams through the real handlers:
+
+    browse -> order -> payment proof -> admin approve
+
+Reports p50/p99 handler latency per step and database statements/commits per update.
+No token or network access needed, so it can run in CI:
+
+    python loadtest.py flows --users 200 --rate 50 --latency-ms 20 --p429 0.01
+    python loadtest.py flows --runtime async --concurrency 200   # RUNTIME=async handlers
+    python loadtest.py broadcast --users 2000 --blocked 0.05
+    python loadtest.py abuse --abusers 3 --taps 50              # update guard vs. tap-happy users
+    python loadtest.py keyboards                               # static keyboard micro-benchmark
+    python loadtest.py queries                                 # per-handler query budget (exit 1 on regression)
+    python loadtest.py flows --max-p99-ms 250 --max-queries 12   # exit 1 on regression
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# ============================
+# Fake Bot API
+# ============================
+class _ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # the default backlog of 5 shows up as 1s SYN retries under load
+
+class FakeBotApi:
+    """
+    Minimal Bot API over HTTP. Every call is recorded as (method, params).
+    p429: probability a call is answered with 429 + retry_after.
+    blocked: chat ids that get 403 "bot was blocked by the user".
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, p429: float = 0.0,
+                 retry_after: int = 1, blocked=()):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.blocked = set(int(x) for x in blocked)
+        self.calls = []
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self._mid = 1000
+        self.httpd = _ApiServer(("127.0.0.1", 0), self._handler())
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _next_mid(self) -> int:
+        with self.lock:
+            self._mid += 1
+            return self._mid
+
+    def answer(self, method: str, params: dict):
+        """Returns (http status, json body)."""
+        with self.lock:
+            self.calls.append((method, params))
+            self.counts[method] += 1
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None and int(chat_id) in self.blocked:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if self.p429 and random.random() < self.p429:
+            with self.lock:
+                self.counts["429"] += 1
+            return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method == "getFile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "u", "file_size": 0, "file_path": "files/blob"}
+        elif method in ("answerCallbackQuery", "setWebhook", "deleteWebhook", "setMyCommands"):
+            result = True
+        elif method == "copyMessage":
+            result = {"message_id": self._next_mid()}
+        else:
+            result = {"message_id": self._next_mid(), "date": int(time.time()),
+                      "chat": {"id": int(chat_id or 0), "type": "private"}}
+        return 200, {"ok": True, "result": result}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org
+
+            def _serve(self):
+                parts = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if parts.path.startswith("/file/"):
+                    body, status = b"", 200
+                else:
+                    params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+                    if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                        # AsyncTeleBot posts form bodies; multipart uploads are accepted and dropped
+                        params.update({k: v[-1] for k, v in parse_qs(raw.decode("utf-8")).items()})
+                    status, doc = api.answer(parts.path.rsplit("/", 1)[-1], params)
+                    body = json.dumps(doc).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, fmt, *args):
+                pass
+
+        return Handler
+
+# ============================
+# Bot under test
+# ============================
+def load_bot(args, api: FakeBotApi):
+    """Configure env, import Promain and point telebot at the fake API."""
+    if not os.getenv("DATABASE_URL"):
+        db = os.path.join(tempfile.mkdtemp(prefix="shopbot-load-"), "bot.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{db}"
+    os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+    os.environ.setdefault("SUPPORT_USERNAME", "loadtest_support")
+    os.environ.setdefault("CARD_NUMBER", "6037-0000-0000-0000")
+    os.environ.setdefault("ADMIN_IDS", ",".join(str(i) for i in range(1, args.admins + 1)))
+    os.environ["RUN_MODE"] = "webhook"  # non-threaded bot: handlers run inline and can be timed
+    os.environ["RUNTIME"] = args.runtime
+    if args.bcast_rate:
+        os.environ["BROADCAST_GLOBAL_RATE"] = str(args.bcast_rate)
+    if args.command == "queries":
+        # deterministic counts: no timer-driven background flushes in the middle of a step
+        os.environ.setdefault("ACTIVITY_FLUSH_MS", "3600000")
+        os.environ.setdefault("BLOCKED_FLUSH_MS", "3600000")
+        os.environ.setdefault("GUARD_COALESCE_MS", "0")  # steps repeat the same callback data on purpose
+
+    import Promain as P
+    from telebot import apihelper
+    apihelper.API_URL = f"http://127.0.0.1:{api.port}/bot{{0}}/{{1}}"
+    apihelper.FILE_URL = f"http://127.0.0.1:{api.port}/file/bot{{0}}/{{1}}"
+    P.logging.getLogger("ShopBot").setLevel(args.log_level)
+    P.logging.getLogger("TeleBot").setLevel(args.log_level)
+    P.init_db_and_seed()
+    if args.runtime == "async":
+        from telebot import asyncio_helper
+        asyncio_helper.API_URL = apihelper.API_URL
+    return P
+
+class AsyncDriver:
+    """Runs an AsyncRuntime on a background loop; process() blocks until the update is handled."""
+
+    def __init__(self, P):
+        import asyncio
+        self.asyncio = asyncio
+        self.rt = P.AsyncRuntime()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="async-runtime", daemon=True).start()
+
+    def process(self, updates):
+        self.asyncio.run_coroutine_threadsafe(self.rt.bot.process_new_updates(updates), self.loop).result()
+
+    def close(self):
+        from telebot import asyncio_helper
+
+        async def shutdown():
+            if asyncio_helper.session_manager.session is not None:
+                await asyncio_helper.session_manager.session.close()
+            await self.rt.engine.dispose()
+
+        self.asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class DbCounter:
+    """Counts SQL statements and commits on the engine; threads inside quiet() are ignored."""
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.commits = 0
+        self.captured = None  # list of SQL strings while capturing
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.watch(engine)
+
+    def watch(self, engine):
+        from sqlalchemy import event
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, conn, cursor, statement, *a):
+        if not getattr(self.local, "quiet", False):
+            with self.lock:
+                self.statements += 1
+                if self.captured is not None:
+                    self.captured.append(" ".join(statement.split())[:160])
+
+    def _on_commit(self, *a):
+        if not getattr(self.local, "quiet", False):
+            with self.lock:
+                self.commits += 1
+
+    def reset(self):
+        with self.lock:
+            self.statements = self.commits = 0
+
+    def quiet(self):
+        counter = self
+
+        class _Quiet:
+            def __enter__(self):
+                counter.local.quiet = True
+
+            def __exit__(self, *exc):
+                counter.local.quiet = False
+
+        return _Quiet()
+
+# ============================
+# Synthetic update streams
+# ============================
+class UpdateFactory:
+    def __init__(self):
+        self._id = 0
+        self.lock = threading.Lock()
+
+    def _next(self) -> int:
+        with self.lock:
+            self._id += 1
+            return self._id
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"u{uid}", "language_code": "fa"}
+
+    def message(self, uid, text=None, photo=False):
+        n = self._next()
+        m = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        if text is not None:
+            m["text"] = text
+            if text.startswith("/"):
+                m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            m["photo"] = [{"file_id": f"proof-{uid}-{n}", "file_unique_id": f"p{n}", "width": 800, "height": 600}]
+        return {"update_id": n, "message": m}
+
+    def callback(self, uid, data):
+        n = self._next()
+        return {"update_id": n, "callback_query": {
+            "id": str(n), "from": self._user(uid), "chat_instance": "load", "data": data,
+            "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                        "from": {"id": 42, "is_bot": True, "first_name": "LoadTest"}, "text": "menu"}}}
+
+class LoadRunner:
+    def __init__(self, P, db: DbCounter, rate: float):
+        from telebot import types
+        self.P = P
+        self.types = types
+        self.db = db
+        self.updates = UpdateFactory()
+        self.bucket = P.TokenBucket(rate, capacity=1)
+        self.latency = collections.defaultdict(list)  # step -> [seconds]
+        self.errors = collections.Counter()
+        self.lock = threading.Lock()
+        self.process = P.bot.process_new_updates
+
+    def send(self, step: str, update: dict):
+        self.bucket.acquire()
+        upd = self.types.Update.de_json(update)
+        started = time.perf_counter()
+        try:
+            self.process([upd])
+        except Exception as e:
+            with self.lock:
+                self.errors[f"{step}: {type(e).__name__}"] += 1
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latency[step].append(elapsed)
+
+    def open_order_id(self, uid):
+        P = self.P
+        with self.db.quiet():
+            s = P.SessionLocal()
+            try:
+                row = (s.query(P.Order.id).filter(P.Order.user_id == uid, P.Order.status == "proof_submitted")
+                       .order_by(P.Order.id.desc()).first())
+            finally:
+                s.close()
+        return row[0] if row else None
+
+    def flow(self, uid: int, admin_id: int):
+        snap = self.P.catalog.snapshot()
+        self.send("start", self.updates.message(uid, "/start"))
+        if snap.plans and random.random() < 0.5:
+            plan_id = random.choice(list(snap.plans))
+            self.send("browse", self.updates.callback(uid, "nav:apps"))
+            self.send("browse", self.updates.callback(uid, f"app:{snap.plans[plan_id]['app_id']}"))
+            self.send("order", self.updates.callback(uid, f"plan:{plan_id}"))
+        else:
+            self.send("browse", self.updates.callback(uid, "nav:vpn"))
+            self.send("order", self.updates.callback(uid, f"vpn:{random.choice(list(snap.vpn))}"))
+        self.send("proof", self.updates.message(uid, photo=True))
+        order_id = self.open_order_id(uid)
+        if order_id:
+            self.send("approve", self.updates.callback(admin_id, f"adm:approve:{order_id}"))
+
+    def total_updates(self) -> int:
+        return sum(len(v) for v in self.latency.values())
+
+# ============================
+# Reporting
+# ============================
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def report_flows(runner: LoadRunner, db: DbCounter, api: FakeBotApi, wall: float):
+    n = runner.total_updates()
+    everything = [x for v in runner.latency.values() for x in v]
+    print(f"\n{n} updates in {wall:.1f}s ({n / wall if wall else 0:.1f} upd/s)")
+    print(f"{'step':<10}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in ("start", "browse", "order", "proof", "approve"):
+        v = runner.latency.get(step)
+        if v:
+            print(f"{step:<10}{len(v):>8}{pct(v, 50) * 1000:>10.1f}{pct(v, 99) * 1000:>10.1f}{max(v) * 1000:>10.1f}")
+    print(f"{'all':<10}{n:>8}{pct(everything, 50) * 1000:>10.1f}{pct(everything, 99) * 1000:>10.1f}"
+          f"{(max(everything) if everything else 0) * 1000:>10.1f}")
+    print(f"db: {db.statements} statements, {db.commits} commits "
+          f"({db.statements / max(n, 1):.2f} stmt/update, {db.commits / max(n, 1):.2f} commits/update)")
+    print(f"api: {sum(v for k, v in api.counts.items() if k != '429')} calls, {api.counts['429']} injected 429s; "
+          + ", ".join(f"{k}={v}" for k, v in api.counts.most_common(6) if k != "429"))
+    if runner.errors:
+        print("errors: " + ", ".join(f"{k} x{v}" for k, v in runner.errors.most_common()))
+    dropped = guard_drops(runner.P)
+    if dropped:
+        print("guard: " + ", ".join(f"{k}={v:g}" for k, v in sorted(dropped.items())))
+    return pct(everything, 99), db.statements / max(n, 1)
+
+def guard_drops(P):
+    """{"callback/coalesced": n, ...} from the updates_dropped_total counter."""
+    return {f"{dict(labels)['kind']}/{dict(labels)['reason']}": v
+            for (metric, labels), v in P.metrics.counters.items() if metric == "updates_dropped_total"}
+
+# ============================
+# Commands
+# ============================
+def cmd_flows(args, P, api, db):
+    runner = LoadRunner(P, db, args.rate)
+    if args.runtime == "async":
+        driver = AsyncDriver(P)
+        db.watch(driver.rt.engine.sync_engine)
+        runner.process = driver.process
+    base = 100000
+    admins = [int(x) for x in os.environ["ADMIN_IDS"].split(",")]
+    db.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(runner.flow, base + i, admins[i % len(admins)]) for i in range(args.users)]
+        for f in futures:
+            f.result()
+    P.admin_notifier.executor.shutdown(wait=True)  # admin copies of the receipts
+    P.activity_buffer.flush()
+    wall = time.perf_counter() - started
+    if args.runtime == "async":
+        driver.close()
+    p99, stmts = report_flows(runner, db, api, wall)
+    failed = False
+    if args.max_p99_ms and p99 * 1000 > args.max_p99_ms:
+        print(f"FAIL: p99 {p99 * 1000:.1f}ms > {args.max_p99_ms}ms"); failed = True
+    if args.max_queries and stmts > args.max_queries:
+        print(f"FAIL: {stmts:.2f} statements/update > {args.max_queries}"); failed = True
+    return 1 if failed else 0
+
+def cmd_abuse(args, P, api, db):
+    """Normal flows while a few users hammer vpn:<id>; the update guard should keep their orders to a handful."""
+    runner = LoadRunner(P, db, args.rate)
+    vpn_id = next(iter(P.catalog.snapshot().vpn))
+    admins = [int(x) for x in os.environ["ADMIN_IDS"].split(",")]
+    abusers = list(range(400000, 400000 + args.abusers))
+
+    def hammer(uid):
+        runner.send("start", runner.updates.message(uid, "/start"))
+        for _ in range(args.taps):
+            runner.send("order", runner.updates.callback(uid, f"vpn:{vpn_id}"))
+
+    db.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency + len(abusers)) as pool:
+        futures = [pool.submit(hammer, uid) for uid in abusers]
+        futures += [pool.submit(runner.flow, 100000 + i, admins[i % len(admins)]) for i in range(args.users)]
+        for f in futures:
+            f.result()
+    P.admin_notifier.executor.shutdown(wait=True)
+    P.activity_buffer.flush()
+    report_flows(runner, db, api, time.perf_counter() - started)
+    with db.quiet():
+        s = P.SessionLocal()
+        try:
+            total = s.scalar(P.select(P.func.count(P.Order.id)))
+            abusive = s.scalar(P.select(P.func.count(P.Order.id)).where(P.Order.user_id.in_(abusers)))
+        finally:
+            s.close()
+    share = abusive / total if total else 0.0
+    print(f"abusers: {len(abusers)} x {args.taps} taps -> {abusive} orders ({share:.0%} of {total})")
+    if args.max_abuse_share and share > args.max_abuse_share:
+        print(f"FAIL: abusers own {share:.0%} of orders > {args.max_abuse_share:.0%}")
+        return 1
+    return 0
+
+def cmd_broadcast(args, P, api, db):
+    user_ids = list(range(200000, 200000 + args.users))
+    api.blocked.update(random.sample(user_ids, int(len(user_ids) * args.blocked)))
+    db.reset()
+    stats = P.broadcast_copy({"from_chat_id": 1, "message_id": 1}, user_ids)
+    print(f"\nbroadcast: {stats.summary()}")
+    print(f"api: {api.counts['copyMessage']} copyMessage calls, {api.counts['429']} injected 429s")
+    print(f"db: {db.statements} statements, {db.commits} commits")
+    return 0
+
+def cmd_keyboards(args, P, api, db):
+    """Micro-benchmark: build + serialize each static keyboard vs. the registry's cached markup."""
+    import timeit
+    from telebot import apihelper
+    n = args.iterations
+    print(f"\n{'keyboard':<24}{'build us':>10}{'cached us':>11}{'saved us':>10}")
+    saved_total = 0.0
+    for name, builder in P.keyboards.builders.items():
+        cached = getattr(P, name)
+        built = timeit.timeit(lambda: apihelper._convert_markup(builder()), number=n) / n * 1e6
+        reused = timeit.timeit(lambda: apihelper._convert_markup(cached()), number=n) / n * 1e6
+        saved_total += built - reused
+        print(f"{name:<24}{built:>10.1f}{reused:>11.2f}{built - reused:>10.1f}")
+    print(f"average saving per keyboard-bearing update: {saved_total / max(1, len(P.keyboards.builders)):.1f} us")
+    return 0
+
+# Statements per update with warm caches. A handler going over its budget fails the run;
+# raise a number only together with the change that needs the extra query.
+QUERY_BUDGETS = {
+    "start (new user)": 1,
+    "start (returning)": 0,
+    "nav:vpn": 0,
+    "nav:settings": 1,
+    "usr:toggle_bcast": 1,
+    "vpn order": 2,
+    "payment proof": 2,
+    "adm:approve": 3,
+    "adm:users_count": 2,
+    "brw:u": 1,
+    "brw:ud": 2,
+    "brw:od": 1,
+    "adm:mg_apps": 2,
+}
+
+def cmd_queries(args, P, api, db):
+    """Query-count regression check: run each handler once and compare with QUERY_BUDGETS."""
+    from telebot import types
+    f = UpdateFactory()
+    admin = int(os.environ["ADMIN_IDS"].split(",")[0])
+    vpn_id = next(iter(P.catalog.snapshot().vpn))
+
+    def measure(uid, steps):
+        out = {}
+        for name, update in steps:
+            db.reset()
+            db.captured = []
+            P.bot.process_new_updates([types.Update.de_json(update() if callable(update) else update)])
+            P.db_writer.run(lambda s: None)  # wait for queued writes of this update
+            out[name] = (db.statements, db.captured)
+            db.captured = None
+        return out
+
+    def order_id(uid):
+        with db.quiet():
+            s = P.SessionLocal()
+            try:
+                return s.query(P.Order.id).filter(P.Order.user_id == uid).order_by(P.Order.id.desc()).first()[0]
+            finally:
+                s.close()
+
+    def steps(uid):
+        return [
+            ("start (new user)", f.message(uid, "/start")),
+            ("start (returning)", f.message(uid, "/start")),
+            ("nav:vpn", f.callback(uid, "nav:vpn")),
+            ("nav:settings", f.callback(uid, "nav:settings")),
+            ("usr:toggle_bcast", f.callback(uid, "usr:toggle_bcast")),
+            ("vpn order", f.callback(uid, f"vpn:{vpn_id}")),
+            ("payment proof", f.message(uid, photo=True)),
+            ("adm:approve", lambda: f.callback(admin, f"adm:approve:{order_id(uid)}")),
+            ("adm:users_count", f.callback(admin, "adm:users_count")),
+            ("brw:u", f.callback(admin, "brw:u")),
+            ("brw:ud", f.callback(admin, f"brw:ud:{uid}")),
+            ("brw:od", lambda: f.callback(admin, f"brw:od:{order_id(uid)}")),
+            ("adm:mg_apps", f.callback(admin, "adm:mg_apps")),
+        ]
+
+    measure(300000, steps(300000))  # warm-up: catalog, settings, blocked-user set
+    results = measure(300001, steps(300001))
+    failed = False
+    print(f"\n{'handler':<22}{'stmts':>7}{'budget':>8}")
+    for name, (count, statements) in results.items():
+        budget = QUERY_BUDGETS.get(name)
+        over = budget is not None and count > budget
+        failed |= over
+        print(f"{name:<22}{count:>7}{budget if budget is not None else '-':>8}{'  OVER' if over else ''}")
+        if over or args.verbose:
+            for sql in statements:
+                print(f"    {sql}")
+    return 1 if failed else 0
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Offline load test for the shop bot.")
+    ap.add_argument("command", choices=["flows", "abuse", "broadcast", "keyboards", "queries"])
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--rate", type=float, default=100.0, help="target updates/sec (flows)")
+    ap.add_argument("--concurrency", type=int, default=16, help="flows in flight")
+    ap.add_argument("--admins", type=int, default=2)
+    ap.add_argument("--runtime", choices=["sync", "async"], default="sync", help="flows: bot runtime under test")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="fake API latency per call")
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--p429", type=float, default=0.0, help="probability a call gets 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--abusers", type=int, default=3, help="abuse: users hammering vpn:<id>")
+    ap.add_argument("--taps", type=int, default=50, help="abuse: taps per abuser")
+    ap.add_argument("--max-abuse-share", type=float, default=0.0, help="abuse: exit 1 if abusers own more of the orders")
+    ap.add_argument("--blocked", type=float, default=0.0, help="fraction of broadcast users that blocked the bot")
+    ap.add_argument("--bcast-rate", type=float, default=0.0, help="override BROADCAST_GLOBAL_RATE")
+    ap.add_argument("--max-p99-ms", type=float, default=0.0, help="exit 1 if overall p99 exceeds this")
+    ap.add_argument("--max-queries", type=float, default=0.0, help="exit 1 if statements/update exceed this")
+    ap.add_argument("--iterations", type=int, default=20000, help="keyboards: calls per measurement")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--log-level", default="CRITICAL")
+    ap.add_argument("--verbose", action="store_true", help="queries: print every statement")
+    return ap.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.p429, args.retry_after).start()
+    try:
+        P = load_bot(args, api)
+        db = DbCounter(P.engine)
+        commands = {"flows": cmd_flows, "abuse": cmd_abuse, "broadcast": cmd_broadcast, "keyboards": cmd_keyboards, "queries": cmd_queries}
+        return commands[args.command](args, P, api, db)
+    finally:
+        api.stop()
+
+if __name__ == "__main__":
+    sys.exit(main())
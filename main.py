@@ -2,6 +2,10 @@
 import io
 import csv
 import time
+import json
+import sqlite3
+import threading
+import functools
 import telebot
 from telebot import types
 from telebot.types import Message, CallbackQuery
@@ -34,16 +38,91 @@ APPS = {
 }
 
 # ================= STATE =================
+STATE_FILE = None      # e.g. "state.db" → flows are shared by every bot process using the file
+STATE_TTL = 24 * 3600  # seconds
+
+class StateStore:
+    """Key/value state with TTL, in memory or in a shared SQLite file. Every call is one atomic statement."""
+
+    def __init__(self, namespace, path=STATE_FILE, ttl=STATE_TTL):
+        self.ns = namespace
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.mem = {}
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state (k TEXT PRIMARY KEY, v TEXT NOT NULL, exp REAL NOT NULL)")
+
+    def _k(self, key):
+        return f"{self.ns}:{key}"
+
+    def get(self, key, default=None):
+        with self.lock:
+            if self.db is None:
+                item = self.mem.get(key)
+                return item[1] if item and item[0] >= time.time() else default
+            row = self.db.execute("SELECT v FROM state WHERE k=? AND exp>=?", (self._k(key), time.time())).fetchone()
+            return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self.lock:
+            if self.db is None:
+                self.mem[key] = (time.time() + self.ttl, value)
+                return
+            self.db.execute("INSERT INTO state (k, v, exp) VALUES (?, ?, ?) "
+                            "ON CONFLICT(k) DO UPDATE SET v=excluded.v, exp=excluded.exp",
+                            (self._k(key), json.dumps(value), time.time() + self.ttl))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if self.db is None:
+                item = self.mem.pop(key, None)
+                return item[1] if item and item[0] >= time.time() else default
+            row = self.db.execute("DELETE FROM state WHERE k=? RETURNING v, exp", (self._k(key),)).fetchone()
+            return json.loads(row[0]) if row and row[1] >= time.time() else default
+
+    # set-style helpers for flags
+    def add(self, key):
+        self.set(key, True)
+
+    def discard(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
 USERS = set()
 MAINTENANCE = {"enabled": False}
-PENDING_PAYMENT = {}  # {user_id: {"category": "vpn"|"app", "item": "title/text"}}
+PENDING_PAYMENT = StateStore("pending")  # {user_id: {"category": "vpn"|"app", "item": "title/text"}}
 
 # --- NEW: Broadcast state (per-admin) ---
 # Keeps the draft message location to copy from later
-BROADCAST_DRAFT = {}   # {admin_id: {"from_chat_id": int, "message_id": int}}
-BROADCAST_AWAIT = set()  # set of admin_ids who are expected to send a draft next
+BROADCAST_DRAFT = StateStore("draft")   # {admin_id: {"from_chat_id": int, "message_id": int}}
+BROADCAST_AWAIT = StateStore("await")   # admin_ids who are expected to send a draft next
 
 # ================= KEYBOARDS =================
+# Every keyboard here is built from constants, so each one is built and serialized once.
+class FrozenMarkup(types.JsonSerializable):
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+def frozen(builder):
+    cache = {}
+
+    @functools.wraps(builder)
+    def wrapper(*args):
+        kb = cache.get(args)
+        if kb is None:
+            kb = cache[args] = FrozenMarkup(builder(*args))
+        return kb
+    return wrapper
+
+@frozen
 def main_menu_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -54,6 +133,7 @@ def main_menu_keyboard():
     )
     return kb
 
+@frozen
 def vpn_menu_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, product in enumerate(VPN_PRODUCTS):
@@ -61,6 +141,7 @@ def vpn_menu_keyboard():
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
+@frozen
 def apps_menu_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=1)
     for key, app in APPS.items():
@@ -68,6 +149,7 @@ def apps_menu_keyboard():
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
+@frozen
 def app_plans_keyboard(app_key):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, plan in enumerate(APPS[app_key]["plans"]):
@@ -75,12 +157,14 @@ def app_plans_keyboard(app_key):
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="buy_apps"))
     return kb
 
+@frozen
 def payment_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("💳 واریز به کارت", callback_data="pay_card"))
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
+@frozen
 def contact_keyboard():
     url = f"https://t.me/{SUPPORT_USERNAME}"
     kb = types.InlineKeyboardMarkup(row_width=1)
@@ -88,6 +172,7 @@ def contact_keyboard():
     kb.add(types.InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
+@frozen
 def admin_menu_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -102,6 +187,7 @@ def admin_menu_keyboard():
     return kb
 
 # --- NEW: Broadcast confirm keyboard ---
+@frozen
 def broadcast_confirm_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -115,7 +201,7 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 def mark_pending(uid: int, category: str, item: str):
-    PENDING_PAYMENT[uid] = {"category": category, "item": item}
+    PENDING_PAYMENT.set(uid, {"category": category, "item": item})
 
 def user_tag(u) -> str:
     name = " ".join(x for x in [u.first_name or "", u.last_name or ""] if x).strip() or (f"@{u.username}" if u.username else "بدون‌نام")
@@ -377,10 +463,10 @@ def handle_admin_broadcast_draft(message: Message):
         return
 
     # Save draft location (we will copy this message to all users)
-    BROADCAST_DRAFT[message.from_user.id] = {
+    BROADCAST_DRAFT.set(message.from_user.id, {
         "from_chat_id": message.chat.id,
         "message_id": message.message_id
-    }
+    })
     BROADCAST_AWAIT.discard(message.from_user.id)
 
     # Show a confirmation UI to the admin